@@ -0,0 +1,44 @@
+"""
+Command line interface of the downscaling models, run with
+
+    python -m downscaling run pipeline.yaml
+
+from the folder containing `downscaling`. See `pipeline.pipeline` for the
+configuration of a pipeline.
+"""
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from pipeline import pipeline
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m downscaling",
+        description="Run statistical downscaling models without the user "
+                    "interface.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser(
+        'run', help="Run the IDW, CFM and KNN stages of a pipeline.")
+    run.add_argument('config', help="YAML or JSON pipeline configuration.")
+    run.add_argument('-j', '--n-jobs', type=int,
+                     help="Number of worker processes of each stage.")
+    run.add_argument('--chunk-size', type=int,
+                     help="Number of time steps IDW interpolates at a time.")
+    run.add_argument('-q', '--quiet', action='store_true',
+                     help="Do not print progress.")
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        config = pipeline.load_config(args.config)
+        pipeline.run(config, n_jobs=args.n_jobs, chunk_size=args.chunk_size,
+                     verbose=not args.quiet)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+"""
+Benchmarks of the downscaling models on synthetic data.
+
+Benchmarks follow the conventions of asv (airspeed velocity): each class
+has `params` and `param_names` for the scaling axes, a `setup` method
+creating the inputs, and `time_*` and `peakmem_*` methods that are timed
+and memory profiled. They can be run with asv, or without any extra
+dependency by running this file:
+
+    python bench_models.py [pattern]
+
+which reports the best time and the peak memory allocated by each
+benchmark whose name contains `pattern` for every combination of
+parameters.
+"""
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+# Import the generators and models whether run by asv or as a script
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(HERE)
+sys.path.append(os.path.join(HERE, ".."))
+
+import synthetic
+from idw import idw
+from cfm import cfm
+from knncad import knn
+
+
+class InvDist:
+    params = ([10, 100, 1000], [50, 200])
+    param_names = ['stations', 'grid']
+
+    def setup(self, n_stations, size):
+        self.data, self.lat, self.lon = synthetic.grid_array(365, size, size)
+        points = synthetic.stations(n_stations).values()
+        self.points = np.array(list(points))
+
+    def time_inv_dist(self, n_stations, size):
+        idw.inv_dist(self.data, self.lat, self.lon, self.points)
+
+    def peakmem_inv_dist(self, n_stations, size):
+        idw.inv_dist(self.data, self.lat, self.lon, self.points)
+
+
+class IDW:
+    params = ([1, 10], [10, 100], [20, 50])
+    param_names = ['years', 'stations', 'grid']
+
+    def setup(self, years, n_stations, size):
+        self.tmp = tempfile.mkdtemp()
+        self.file = synthetic.grid(os.path.join(self.tmp, 'tas.nc'), years,
+                                   size, size)
+        self.stations = synthetic.stations(n_stations)
+
+    def teardown(self, years, n_stations, size):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def time_idw(self, years, n_stations, size):
+        idw.idw(self.file, 'tas', self.stations)
+
+    def time_idw_gather(self, years, n_stations, size):
+        idw.idw(self.file, 'tas', self.stations, gather=True)
+
+    def peakmem_idw(self, years, n_stations, size):
+        idw.idw(self.file, 'tas', self.stations)
+
+
+class CFM:
+    params = ([10, 30], [10, 50], [10, 25])
+    param_names = ['years', 'stations', 'bins']
+
+    def setup(self, years, n_stations, bins):
+        self.his = synthetic.frame(years, n_stations, seed=1)
+        self.fut = synthetic.frame(years, n_stations, start=2040, seed=2)
+        self.obs = synthetic.frame(years, n_stations, seed=3)
+        self.method = {'pr': 1, 'tasmax': 0, 'tasmin': 0}
+
+    def time_cfm(self, years, n_stations, bins):
+        cfm.cfm(self.his, self.fut, self.obs, self.method, bins)
+
+    def peakmem_cfm(self, years, n_stations, bins):
+        cfm.cfm(self.his, self.fut, self.obs, self.method, bins)
+
+
+class KNNFit:
+    params = ([10, 30], [5, 20])
+    param_names = ['years', 'stations']
+
+    def setup(self, years, n_stations):
+        self.X = synthetic.frame(years, n_stations)
+        self.P = synthetic.perturbation(self.X.columns)
+
+    def time_init(self, years, n_stations):
+        knn.KNN(self.X, self.P)
+
+    def peakmem_init(self, years, n_stations):
+        knn.KNN(self.X, self.P)
+
+
+class KNNBootstrap:
+    params = ([10, 30], [5, 20], [1, 10])
+    param_names = ['years', 'stations', 'replications']
+
+    def setup(self, years, n_stations, runs):
+        X = synthetic.frame(years, n_stations)
+        self.generator = knn.KNN(X, synthetic.perturbation(X.columns))
+        # Compile the resampling kernel outside of the timings
+        self.generator.bootstrap(0, 0)
+
+    def time_bootstrap(self, years, n_stations, runs):
+        for r in range(runs):
+            self.generator.bootstrap(r, r)
+
+    def time_bootstrap_many(self, years, n_stations, runs):
+        self.generator.bootstrap_many(runs, seed=0)
+
+    def peakmem_bootstrap_many(self, years, n_stations, runs):
+        self.generator.bootstrap_many(runs, seed=0)
+
+
+def run(pattern='', repeat=3):
+    """
+    Run the benchmarks without asv and print the results.
+
+    Parameters
+    ----------
+    pattern : str
+        Only run benchmarks whose `Class.method` name contains `pattern`.
+    repeat : int
+        Number of times each `time_*` benchmark is run, of which the best is
+        reported.
+    """
+    classes = [InvDist, IDW, CFM, KNNFit, KNNBootstrap]
+
+    for cls in classes:
+        methods = [m for m in dir(cls)
+                   if m.startswith(('time_', 'peakmem_'))
+                   and pattern in f"{cls.__name__}.{m}"]
+
+        for params in itertools.product(*cls.params):
+            if not methods:
+                break
+
+            bench = cls()
+            bench.setup(*params)
+            label = ", ".join(f"{n}={p}"
+                              for n, p in zip(cls.param_names, params))
+
+            for m in methods:
+                func = getattr(bench, m)
+
+                if m.startswith('time_'):
+                    times = []
+                    for i in range(repeat):
+                        t = time.perf_counter()
+                        func(*params)
+                        times.append(time.perf_counter() - t)
+                    result = f"{min(times):.4f} s"
+                else:
+                    tracemalloc.start()
+                    func(*params)
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                    result = f"{peak / 2**20:.1f} MiB"
+
+                print(f"{cls.__name__}.{m}({label}): {result}", flush=True)
+
+            if hasattr(bench, 'teardown'):
+                bench.teardown(*params)
+
+
+if __name__ == '__main__':
+    run(*sys.argv[1:2])
@@ -0,0 +1,142 @@
+import pandas as pd
+import numpy as np
+import xarray as xr
+
+# Variables of the synthetic frames
+VARIABLES = ('pr', 'tasmax', 'tasmin')
+
+
+def stations(n, extent=(55, 245, 45, 230), seed=0):
+    """
+    Random station locations within an extent.
+
+    Parameters
+    ----------
+    n : int
+        Number of stations.
+    extent : list
+        Spatial domain `[north, east, south, west]` in degrees, see `idw.idw`.
+    seed : int
+        Seed of the random number generator.
+
+    Returns
+    -------
+    stations : dict
+        Maps each station name to a (lat, lon) tuple.
+    """
+    rng = np.random.default_rng(seed)
+    north, east, south, west = extent
+
+    lat = rng.uniform(south, north, n)
+    lon = rng.uniform(west, east, n)
+
+    return {f'S{i}': (lat[i], lon[i]) for i in range(n)}
+
+
+def grid_array(days, nlat, nlon, extent=(55, 245, 45, 230), seed=0):
+    """
+    Random gridded daily data of shape (days, nlat, nlon) covering an extent,
+    along with the latitude and longitude of the grid.
+    """
+    rng = np.random.default_rng(seed)
+    north, east, south, west = extent
+
+    lat = np.linspace(south, north, nlat)
+    lon = np.linspace(west, east, nlon)
+    data = rng.normal(10, 5, (days, nlat, nlon))
+
+    return data, lat, lon
+
+
+def grid(path, years, nlat, nlon, varname='tas', start=1980,
+         extent=(55, 245, 45, 230), seed=0):
+    """
+    Write a netCDF file of random daily temperature in K on a 365 day
+    calendar, as read by `idw.idw`.
+
+    Parameters
+    ----------
+    path : str
+        Path of the netCDF file.
+    years : int
+        Length of the record in years.
+    nlat, nlon : int
+        Size of the grid.
+    varname : str
+        Name of the variable.
+    start : int
+        First year of the record.
+    extent : list
+        Spatial domain `[north, east, south, west]` of the grid.
+    seed : int
+        Seed of the random number generator.
+    """
+    data, lat, lon = grid_array(365 * years, nlat, nlon, extent, seed)
+    time = 365 * (start - 1850) + np.arange(365 * years, dtype=float)
+
+    ds = xr.Dataset(
+        {varname: (('time', 'lat', 'lon'), (data + 273.15).astype('f4'),
+                   {'units': 'K'})},
+        coords={'time': ('time', time, {'units': 'days since 1850-01-01',
+                                        'calendar': '365_day'}),
+                'lat': lat, 'lon': lon})
+    ds.to_netcdf(path)
+
+    return path
+
+
+def frame(years, n_stations, variables=VARIABLES, start=1980, seed=0):
+    """
+    Random daily data with a (Year, Month, Day) index and (Variable, Station)
+    columns, as used by the CFM and KNN models. Precipitation is
+    intermittent and gamma distributed, other variables follow a seasonal
+    cycle with normal noise.
+
+    Parameters
+    ----------
+    years : int
+        Length of the record in years, starting on Jan 1 and ending on
+        Dec 31.
+    n_stations : int
+        Number of stations.
+    variables : tuple
+        Names of the variables.
+    start : int
+        First year of the record.
+    seed : int
+        Seed of the random number generator.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        The synthetic data.
+    """
+    rng = np.random.default_rng(seed)
+
+    dates = pd.date_range(f'{start}-01-01', f'{start + years - 1}-12-31')
+    index = pd.MultiIndex.from_arrays(
+        [dates.year, dates.month, dates.day], names=['Year', 'Month', 'Day'])
+    columns = pd.MultiIndex.from_product(
+        [variables, [f'S{i}' for i in range(n_stations)]],
+        names=['Variable', 'Station'])
+
+    n = dates.size
+    season = np.sin(2 * np.pi * dates.dayofyear.values / 365)[:, None]
+
+    values = []
+    for v in variables:
+        if v == 'pr':
+            wet = rng.random((n, n_stations)) < 0.4
+            values.append(wet * rng.gamma(0.7, 5, (n, n_stations)))
+        else:
+            values.append(10 * season + rng.normal(0, 3, (n, n_stations)))
+
+    return pd.DataFrame(np.hstack(values), index=index, columns=columns)
+
+
+def perturbation(columns):
+    """
+    Perturbation type of each column for `knn.KNN`, log-normal for
+    precipitation and normal otherwise.
+    """
+    return np.array([2 if v == 'pr' else 1 for v, s in columns], np.uint8)
@@ -0,0 +1,220 @@
+from functools import partial
+import glob
+import hashlib
+import json
+import os
+
+import pandas as pd
+import numpy as np
+
+from frameio import frameio
+
+# Size of the blocks in which input files are hashed
+BLOCK_SIZE = 2**20
+
+
+class ResultCache:
+    def __init__(self, folder, max_size=None, max_entries=None,
+                 hash_content=False):
+        """
+        Content-addressed on-disk cache of model results. Results are keyed by
+        a hash of the model function, the content of its input frames and
+        arrays, its input files and its parameters, so that rerunning the
+        same configuration of a model returns the stored result instead of
+        computing it again. Results are stored as `.npz` files, and the least
+        recently used entries are evicted once the cache is over its size.
+
+        Parameters
+        ----------
+        folder : str
+            Folder in which results are stored.
+        max_size : int, optional
+            Maximum total size of the stored results in bytes.
+        max_entries : int, optional
+            Maximum number of stored results.
+        hash_content : bool, default False
+            Key input files by their content rather than by their path, size
+            and modification time. This also recognizes copied or touched
+            files, but reads every input file in full on each lookup, which
+            can cost more than the result it saves for large netCDF archives.
+        """
+        self.folder = folder
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.hash_content = hash_content
+
+    def path(self, key):
+        return os.path.join(self.folder, f"{key}.npz")
+
+    def key(self, fn, *args, **kwargs):
+        """
+        Hash identifying a call of `fn` with the given arguments, see
+        `hash_value` for how arguments are hashed.
+        """
+        h = hashlib.sha1()
+        h.update(f"{fn.__module__}.{fn.__qualname__}".encode())
+
+        for value in args:
+            hash_value(h, value, self.hash_content)
+        for name in sorted(kwargs):
+            h.update(name.encode())
+            hash_value(h, kwargs[name], self.hash_content)
+
+        return h.hexdigest()
+
+    def get(self, key):
+        """
+        Get a stored result, or None if there is none for `key`.
+        """
+        path = self.path(key)
+
+        try:
+            result = frameio.read_frame(path)
+        except FileNotFoundError:
+            return None
+
+        # Mark the entry as recently used, unless another process has just
+        # evicted it
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        return result
+
+    def put(self, key, result):
+        """
+        Store a result DataFrame under `key`, evicting the least recently
+        used entries if the cache is over its size.
+        """
+        os.makedirs(self.folder, exist_ok=True)
+
+        # Other processes may be reading the cache
+        write = partial(frameio.write_frame, result)
+        frameio.write_atomic(self.path(key), write)
+
+        self.evict()
+
+    def call(self, fn, *args, ignore=(), **kwargs):
+        """
+        Return the stored result of `fn(*args, **kwargs)`, calling it and
+        storing its result if it has not been cached yet.
+
+        Parameters
+        ----------
+        fn : callable
+            Module level function returning a pandas.DataFrame.
+        *args, **kwargs
+            Arguments of `fn`.
+        ignore : tuple of str
+            Names of keyword arguments that do not affect the result, such as
+            the number of worker processes, which are left out of the key.
+
+        Returns
+        -------
+        result : pandas.DataFrame
+            The result of the call.
+        """
+        params = {k: v for k, v in kwargs.items() if k not in ignore}
+        key = self.key(fn, *args, **params)
+
+        result = self.get(key)
+        if result is None:
+            result = fn(*args, **kwargs)
+            self.put(key, result)
+
+        return result
+
+    def entries(self):
+        """
+        Stored entries as a list of (path, size, last use) tuples, from the
+        least to the most recently used.
+        """
+        entries = []
+
+        for path in glob.glob(os.path.join(self.folder, '*.npz')):
+            if path.endswith('.tmp.npz'):
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+
+        return sorted(entries, key=lambda e: e[2])
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is within
+        `max_size` and `max_entries`.
+        """
+        entries = self.entries()
+        size = sum(e[1] for e in entries)
+
+        while entries and (
+                (self.max_size is not None and size > self.max_size) or
+                (self.max_entries is not None and
+                 len(entries) > self.max_entries)):
+            path, nbytes, _ = entries.pop(0)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= nbytes
+
+    def clear(self):
+        """
+        Remove all stored results.
+        """
+        for path, _, _ in self.entries():
+            os.remove(path)
+
+
+def hash_value(h, value, content=False):
+    """
+    Update a hash with the content of a value.
+
+    * pandas.DataFrame - values, index and columns.
+    * ndarray - type, shape and data.
+    * str - the files it refers to if it is the path of a file or a
+      wildcard pattern matching files, as passed to `idw.idw`, see
+      `hash_file`, and the string itself otherwise.
+    * list and tuple - each item in turn.
+    * other values - their JSON representation, with dict keys sorted.
+    """
+    if isinstance(value, pd.DataFrame):
+        h.update(b'frame')
+        h.update(pd.util.hash_pandas_object(value, index=True).values)
+        h.update(repr(list(value.columns)).encode())
+        h.update(repr(list(value.dtypes.astype(str))).encode())
+    elif isinstance(value, np.ndarray):
+        h.update(f"array:{value.dtype}:{value.shape}".encode())
+        h.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, str) and os.path.isfile(value):
+        hash_file(h, value, content)
+    elif isinstance(value, str) and '*' in value and glob.glob(value):
+        for path in sorted(glob.glob(value)):
+            hash_file(h, path, content)
+    elif isinstance(value, (list, tuple)):
+        h.update(f"seq:{len(value)}".encode())
+        for item in value:
+            hash_value(h, item, content)
+    else:
+        h.update(json.dumps(value, sort_keys=True, default=str).encode())
+
+
+def hash_file(h, path, content=False):
+    """
+    Update a hash with a file, identified by its absolute path, size and
+    modification time, or if `content` is True by its content.
+    """
+    if not content:
+        stat = os.stat(path)
+        h.update(f"file:{os.path.abspath(path)}:{stat.st_size}:"
+                 f"{stat.st_mtime_ns}".encode())
+        return
+
+    h.update(b'file')
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            h.update(block)
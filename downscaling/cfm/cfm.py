@@ -1,8 +1,17 @@
+import os
+import warnings
+
 import pandas as pd
 import numpy as np
 
+from frameio import frameio
+from parallel import parallel
+
+# Observed bins shared by the tasks of a worker process, see `init_worker`
+OBSERVED = None
 
-def cfm(his, fut, obs, method, bins=25):
+
+def cfm(his, fut, obs, method, bins=25, engine='numpy', dtype=np.float64):
     """
     Apply change factor methodology to scale hist data using fut and
     hist climate models.
@@ -15,21 +24,356 @@ def cfm(his, fut, obs, method, bins=25):
         Future GCM data
     obs : pandas.DataFrame
         Observed data
-    method : int
-        A 1d numpy array containing 0's and 1's to indicate the scaling method
-        to use.
+    method : int, 1d array or dict
+        0's and 1's to indicate the scaling method to use. Either a single
+        value for all columns, a 1d numpy array with a value for each column of
+        `obs`, or a dict mapping variable names (the first column level) to a
+        value, so that several variables can be scaled in one call.
         * 0 - Apply additive scaling
         * 1 - Apply multiplicative scaling
     bins : int
         The number of bins to apply scaling separately for.
+    engine : {'numpy', 'pandas'}, default 'numpy'
+        The 'numpy' engine bins and scales all columns and calendar months at
+        once using array operations. The 'pandas' engine loops over each
+        column and calendar month.
+    dtype : numpy dtype, default numpy.float64
+        Floating point type of the values being binned and of the result.
+        Using numpy.float32 halves the memory of the working copies.
 
     Returns
     -------
     obs : pandas.DataFrame
        A future-scaled version of the observed dataset.
     """
-    # Copy the data to a new DataFrame
-    obs = obs.copy()
+    method = column_methods(obs.columns, method)
+
+    if engine == 'pandas':
+        return cfm_pandas(his, fut, obs, method, bins, dtype)
+    elif engine != 'numpy':
+        raise ValueError(f"Unknown engine {engine!r}")
+
+    return ObservedBins(obs, method, bins, dtype).scale(his, fut)
+
+
+def cfm_ensemble(pairs, obs, method, bins=25, n_jobs=1, out=None,
+                 fmt='.csv', dtype=np.float64):
+    """
+    Apply change factor methodology to scale one observed dataset with many
+    pairs of historical and future GCM data, such as the models, scenarios
+    and runs of an ensemble. The observed data is only binned once, and pairs
+    are scaled across a pool of processes.
+
+    Parameters
+    ----------
+    pairs : dict
+        Maps the name of each scenario to a `(his, fut)` tuple. Each of
+        `his` and `fut` is either a pandas.DataFrame or the path to a data
+        file in any format supported by `frameio.read_frame`.
+    obs : pandas.DataFrame
+        Observed data
+    method : int, 1d array or dict
+        Scaling method, see `cfm`.
+    bins : int
+        The number of bins to apply scaling separately for.
+    n_jobs : int, default 1
+        Number of worker processes. With 1 the pairs are scaled in the
+        current process.
+    out : str, optional
+        Output folder. If given, each scenario is written to
+        `scaled_<name><fmt>` in `out` instead of being returned.
+    fmt : str, default '.csv'
+        Extension of the output files, see `frameio.read_frame`.
+    dtype : numpy dtype, default numpy.float64
+        Floating point type of the values, see `cfm`.
+
+    Returns
+    -------
+    result : pandas.DataFrame or dict
+        The scaled observed data of all scenarios stacked with an additional
+        outer `Scenario` index level, or if `out` is given, a dict mapping
+        each scenario to its output file.
+    """
+    observed = ObservedBins(obs, method, bins, dtype)
+
+    def target(name):
+        return os.path.join(out, f"scaled_{name}{fmt}") if out else None
+
+    if n_jobs == 1:
+        results = {name: scale_pair(observed, his, fut, target(name))
+                   for name, (his, fut) in pairs.items()}
+    else:
+        # The observed bins are sent to each worker once, not with each pair
+        with parallel.process_pool(n_jobs, init_worker,
+                                   (observed,)) as pool:
+            futures = {name: pool.submit(scale_worker, his, fut,
+                                         target(name))
+                       for name, (his, fut) in pairs.items()}
+            results = {name: f.result() for name, f in futures.items()}
+
+    if out:
+        return results
+
+    return pd.concat(results, names=['Scenario'])
+
+
+def scale_pair(observed, his, fut, fpath=None):
+    """
+    Scale observed data with a single pair of GCM data. Loads `his` and
+    `fut` if they are file paths, and writes the result to `fpath` if given.
+    """
+    if isinstance(his, str):
+        his = frameio.read_frame(his)
+    if isinstance(fut, str):
+        fut = frameio.read_frame(fut)
+
+    result = observed.scale(his, fut)
+
+    if fpath:
+        frameio.write_frame(result, fpath)
+        return fpath
+
+    return result
+
+
+def init_worker(observed):
+    """
+    Keep the observed bins of a pool of `cfm_ensemble` in a worker process.
+    """
+    global OBSERVED
+    OBSERVED = observed
+
+
+def scale_worker(his, fut, fpath=None):
+    """
+    Run `scale_pair` in a worker process with its observed bins.
+    """
+    return scale_pair(OBSERVED, his, fut, fpath)
+
+
+class ObservedBins:
+    def __init__(self, obs, method, bins=25, dtype=np.float64):
+        """
+        Observed data binned by percentile range for each calendar month and
+        column. Binning is independent of the GCM data, so it only needs to be
+        done once to scale the same observed data with many GCMs.
+
+        Parameters
+        ----------
+        obs : pandas.DataFrame
+            Observed data
+        method : int, 1d array or dict
+            Scaling method, see `cfm`.
+        bins : int
+            The number of bins to apply scaling separately for.
+        dtype : numpy dtype, default numpy.float64
+            Floating point type of the values, see `cfm`.
+        """
+        self.obs = obs
+        self.method = column_methods(obs.columns, method)
+        self.bins = bins
+        self.dtype = np.dtype(dtype)
+
+        # Each calendar month of each column is binned separately
+        self.groups = 12 * obs.shape[1]
+
+        # Calculate bins for each percentile range
+        self.C, self.Cg, self.ci = monthly_values(obs, self.method,
+                                                  self.dtype)
+        self.Cb = quantile_bins(self.C, self.Cg, self.groups, bins)
+
+    def scale(self, his, fut):
+        """
+        Scale the observed data using historical and future GCM data.
+
+        Parameters
+        ----------
+        his : pandas.DataFrame
+            Historical GCM data
+        fut : pandas.DataFrame
+            Future GCM data
+
+        Returns
+        -------
+        obs : pandas.DataFrame
+           A future-scaled version of the observed dataset.
+        """
+        columns = self.obs.columns
+
+        # Extract values to be binned in the same column order as obs
+        A, Ag, _ = monthly_values(his[columns], self.method, self.dtype)
+        B, Bg, _ = monthly_values(fut[columns], self.method, self.dtype)
+
+        # Calculate bins for each percentile range
+        Ab = quantile_bins(A, Ag, self.groups, self.bins)
+        Bb = quantile_bins(B, Bg, self.groups, self.bins)
+
+        # Calculate the mean of each bin
+        Am = bin_means(A, Ag, Ab, self.groups, self.bins)
+        Bm = bin_means(B, Bg, Bb, self.groups, self.bins)
+
+        # Scaling method of each group
+        additive = np.repeat(self.method == 0, 12)
+
+        C, Cg, Cb = self.C, self.Cg, self.Cb
+
+        # Apply scaling transformation
+        with np.errstate(divide='ignore', invalid='ignore'):
+            delta = np.where(additive[:, None], Bm - Am, Bm / Am)[Cg, Cb]
+            C = np.where(additive[Cg], C + delta, C * delta)
+
+        result = self.obs.values.astype(self.dtype)
+        result[self.ci] = C
+
+        return pd.DataFrame(result, index=self.obs.index, columns=columns)
+
+
+def column_methods(columns, method):
+    """
+    Get the scaling method of each column as a 1d array from a single value,
+    array or dict of methods by variable name.
+    """
+    if isinstance(method, dict):
+        method = [method[c[0] if isinstance(c, tuple) else c]
+                  for c in columns]
+
+    method = np.asarray(method, dtype=int)
+
+    if method.ndim == 0:
+        method = np.full(len(columns), method)
+    elif method.shape != (len(columns),):
+        raise ValueError("method must have a value for each column")
+
+    if not np.isin(method, [0, 1]).all():
+        raise ValueError("method must be 0 (additive) or 1 (multiplicative)")
+
+    return method
+
+
+def monthly_values(df, method, dtype=np.float64):
+    """
+    Extract the values of a DataFrame that are to be scaled.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Data with calendar month as the second index level.
+    method : ndarray
+        The scaling method of each column. For multiplicative scaling (1),
+        values of 0.01 or less are excluded.
+    dtype : numpy dtype, default numpy.float64
+        Floating point type of the returned values.
+
+    Returns
+    -------
+    values : ndarray
+        1d array of the values to be scaled.
+    groups : ndarray
+        The group of each value, numbered `12 * column + month - 1`.
+    idx : tuple
+        Row and column indices of the values in `df`.
+    """
+    arr = df.values.astype(dtype, copy=False)
+    month = np.asarray(df.index.get_level_values(1), dtype=float)
+
+    valid = np.isin(month, np.arange(1, 12 + 1))[:, None] & ~np.isnan(arr)
+
+    # Account for zero precipitation
+    valid &= (method == 0) | (arr > 0.01)
+
+    rows, cols = np.nonzero(valid)
+    groups = 12 * cols + month[rows].astype(int) - 1
+
+    return arr[rows, cols], groups, (rows, cols)
+
+
+def quantile_bins(values, groups, n_groups, bins):
+    """
+    Assign values to bins between the quantiles of their group. This is the
+    same as `pd.cut(x, x.quantile(q), labels=False, include_lowest=True)`
+    for each group `x` with `q = np.linspace(0, 1, bins)`, done for all groups
+    at once.
+
+    Parameters
+    ----------
+    values : ndarray
+        1d array of values.
+    groups : ndarray
+        The group of each value from 0 to `n_groups - 1`.
+    n_groups : int
+        Number of groups.
+    bins : int
+        Number of quantiles used as bin edges.
+
+    Returns
+    -------
+    labels : ndarray
+        The bin of each value from 0 to `bins - 2`.
+    """
+    q = np.linspace(0, 1, bins)
+
+    # Lay out the values of each group along a row padded with NaN
+    size = np.bincount(groups, minlength=n_groups)
+    order = np.argsort(groups, kind='stable')
+    pos = np.empty_like(order)
+    pos[order] = np.arange(order.size) - (size.cumsum() - size)[groups[order]]
+
+    padded = np.full((n_groups, max(size.max(initial=0), 1)), np.nan,
+                     dtype=values.dtype)
+    padded[groups, pos] = values
+
+    with warnings.catch_warnings():
+        # Groups without any values are left with NaN bin edges
+        warnings.simplefilter('ignore', RuntimeWarning)
+        # Percentiles give the exact same edges as `pandas.Series.quantile`
+        edges = np.nanpercentile(padded, q * 100, axis=1).T
+
+    if np.any(np.diff(edges[size > 0], axis=1) <= 0):
+        raise ValueError("Bin edges must be unique, try using fewer bins")
+
+    # Rank values and edges together so that the group and value can be
+    # combined exactly into a single sortable integer key
+    _, rank = np.unique(np.concatenate([edges.ravel(), values]),
+                        return_inverse=True)
+    rank = rank.ravel().astype(np.int64)
+    n = rank.max(initial=0) + 1
+
+    edge_keys = np.repeat(np.arange(n_groups), bins) * n + rank[:edges.size]
+    value_keys = groups * n + rank[edges.size:]
+
+    # Count bin edges below each value within its group, with the lowest
+    # edge included in the first bin
+    below = np.searchsorted(edge_keys, value_keys) - groups * bins
+
+    return np.maximum(below - 1, 0)
+
+
+def bin_means(values, groups, labels, n_groups, bins):
+    """
+    Calculate the mean value of each bin of each group.
+
+    Returns
+    -------
+    means : ndarray
+        Array of shape (n_groups, bins - 1). Empty bins are NaN.
+    """
+    idx = groups * (bins - 1) + labels
+    size = n_groups * (bins - 1)
+
+    total = np.bincount(idx, weights=values, minlength=size)
+    count = np.bincount(idx, minlength=size)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (total / count).reshape(n_groups, bins - 1)
+
+
+def cfm_pandas(his, fut, obs, method, bins=25, dtype=np.float64):
+    """
+    Change factor methodology looping over each column and calendar month.
+    See `cfm` for a description of the parameters.
+    """
+    # Copy the data to a new DataFrame of the requested type
+    obs = obs.astype(dtype)
     # Define the bins
     q = np.linspace(0, 1, bins)
     # Define scaling functions
@@ -40,14 +384,16 @@ def cfm(his, fut, obs, method, bins=25):
     fut_month = fut.index.get_level_values(1)
     obs_month = obs.index.get_level_values(1)
 
-    for c in obs.columns:
+    method = column_methods(obs.columns, method)
+
+    for c, method_c in zip(obs.columns, method):
         for m in range(1, 12 + 1):
             # Find rows corresponding to month "m"
             ai = his_month == m
             bi = fut_month == m
             ci = obs_month == m
 
-            if method == 1:
+            if method_c == 1:
                 # Account for zero precipitation
                 ai &= his[c] > 0.01
                 bi &= fut[c] > 0.01
@@ -69,11 +415,11 @@ def cfm(his, fut, obs, method, bins=25):
             Cg = Cm.groupby(Cb)
 
             # Apply scaling transformation
-            if method == 0:
+            if method_c == 0:
                 delta = Bg.mean() - Ag.mean()
-            elif method == 1:
+            elif method_c == 1:
                 delta = Bg.mean() / Ag.mean()
 
-            obs.loc[ci, c] = Cg.transform(scale[method], delta)
+            obs.loc[ci, c] = Cg.transform(scale[method_c], delta)
 
     return obs
@@ -0,0 +1,275 @@
+import glob
+import os
+
+import pandas as pd
+import numpy as np
+
+# File extensions of the supported formats
+FORMATS = ('.csv', '.parquet', '.feather', '.npz')
+# Extension of replication store folders, see `ReplicationStore`
+STORE = '.runs'
+
+
+def frame_format(path):
+    """
+    Get the format of a data file from its extension.
+
+    Returns
+    -------
+    ext : str
+        One of `FORMATS`.
+    """
+    ext = os.path.splitext(path)[1].lower()
+
+    if ext not in FORMATS:
+        raise ValueError(f"Unknown file format {ext!r}, "
+                         f"expected one of {', '.join(FORMATS)}")
+
+    return ext
+
+
+def read_frame(path, levels=3):
+    """
+    Read a DataFrame with a (Year, Month, Day) index and (Variable, Station)
+    columns written by any of the models. The format is determined by the
+    file extension.
+
+    * .csv - Text with a two row header, as used throughout.
+    * .parquet - Apache Parquet, requires pyarrow.
+    * .feather - Apache Arrow IPC, requires pyarrow.
+    * .npz - numpy archive holding the values and index labels.
+    * .runs - folder of replications, see `ReplicationStore`.
+
+    Parameters
+    ----------
+    path : str
+        Path to the file.
+    levels : int, default 3
+        Number of index columns in a CSV file, e.g. 4 for the (Run, Year,
+        Month, Day) output of the KNN weather generator.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        The data with its MultiIndex index and columns.
+    """
+    if os.path.splitext(path)[1].lower() == STORE:
+        return ReplicationStore(path).frame()
+
+    ext = frame_format(path)
+
+    if ext == '.csv':
+        return pd.read_csv(path, index_col=list(range(levels)), header=[0, 1])
+    elif ext == '.parquet':
+        return pd.read_parquet(path)
+    elif ext == '.feather':
+        return pd.read_feather(path)
+
+    with np.load(path, allow_pickle=False) as f:
+        index, columns = read_labels(f)
+
+        return pd.DataFrame(f['values'], index=index, columns=columns)
+
+
+def write_frame(df, path):
+    """
+    Write a DataFrame in the format given by the file extension. See
+    `read_frame` for the supported formats.
+    """
+    ext = frame_format(path)
+
+    if ext == '.csv':
+        df.to_csv(path)
+    elif ext == '.parquet':
+        df.to_parquet(path)
+    elif ext == '.feather':
+        df.to_feather(path)
+    else:
+        np.savez(path, values=df.values, **label_arrays(df.index, df.columns))
+
+
+def write_atomic(path, write):
+    """
+    Write a file with `write(tmp)` to a temporary path in the same folder and
+    move it into place, so that other processes reading `path` never see a
+    partly written file. The temporary path ends with `.tmp` followed by the
+    extension of `path`.
+    """
+    root, ext = os.path.splitext(path)
+    tmp = f"{root}.{os.getpid()}.tmp{ext}"
+
+    write(tmp)
+    os.replace(tmp, path)
+
+
+def label_arrays(index, columns):
+    """
+    Get the labels of a MultiIndex index and columns as a dict of arrays
+    that can be saved in a numpy archive and read with `read_labels`.
+    """
+    arrays = {'index_names': np.array(index.names, dtype=str),
+              'column_names': np.array(columns.names, dtype=str)}
+
+    for i in range(index.nlevels):
+        arrays[f'index_{i}'] = index.get_level_values(i).values
+    for i in range(columns.nlevels):
+        arrays[f'columns_{i}'] = columns.get_level_values(i).values.astype(str)
+
+    return arrays
+
+
+def read_labels(f):
+    """
+    Read the index and columns saved with `label_arrays` from an open numpy
+    archive.
+    """
+    index = pd.MultiIndex.from_arrays(
+        [f[f'index_{i}'] for i in range(len(f['index_names']))],
+        names=list(f['index_names']))
+    columns = pd.MultiIndex.from_arrays(
+        [f[f'columns_{i}'] for i in range(len(f['column_names']))],
+        names=list(f['column_names']))
+
+    return index, columns
+
+
+class ReplicationStore:
+    def __init__(self, path, index=None, columns=None):
+        """
+        On-disk store of replications of a dataset, such as the output of the
+        KNN weather generator. Each replication is a raw `.npy` array in the
+        folder `path`, which is preallocated and written through a memory map
+        so that replications can be streamed to disk without building a
+        DataFrame for each, appended to later, and read back one at a time.
+        The shared (Year, Month, Day) index and columns are kept once in
+        `labels.npz`.
+
+        Parameters
+        ----------
+        path : str
+            Folder of the store, conventionally with a `.runs` extension.
+        index : pandas.MultiIndex, optional
+            Index of a replication. Required to create a new store, and
+            checked against the labels of an existing one.
+        columns : pandas.MultiIndex, optional
+            Columns of a replication. Required to create a new store, and
+            checked against the labels of an existing one.
+        """
+        self.path = path
+        labels = os.path.join(path, 'labels.npz')
+
+        if os.path.exists(labels):
+            with np.load(labels, allow_pickle=False) as f:
+                self.index, self.columns = read_labels(f)
+
+            # Replications of another dataset cannot be added to the store
+            if index is not None and not self.index.equals(
+                    read_labels(label_arrays(index, self.columns))[0]):
+                raise ValueError(f"The index does not match the replication "
+                                 f"store at {path!r}")
+            if columns is not None and not self.columns.equals(
+                    read_labels(label_arrays(self.index, columns))[1]):
+                raise ValueError(f"The columns do not match the replication "
+                                 f"store at {path!r}")
+        elif index is None or columns is None:
+            raise ValueError(f"No replication store at {path!r}, the index "
+                             f"and columns are needed to create one")
+        else:
+            os.makedirs(path, exist_ok=True)
+            np.savez(labels, **label_arrays(index, columns))
+            self.index, self.columns = index, columns
+
+        self.shape = (len(self.index), len(self.columns))
+
+    def run_path(self, run_id):
+        return os.path.join(self.path, f'run_{run_id:06d}.npy')
+
+    @property
+    def runs(self):
+        """
+        Sorted ids of the replications in the store.
+        """
+        files = glob.glob(os.path.join(self.path, 'run_*.npy'))
+        return sorted(int(os.path.basename(f)[4:-4]) for f in files)
+
+    def __len__(self):
+        return len(self.runs)
+
+    def allocate(self, run_id, dtype=np.float64):
+        """
+        Preallocate a replication on disk, replacing any existing one with the
+        same id.
+
+        Returns
+        -------
+        values : numpy.memmap
+            Writable array of the replication to be filled in place.
+        """
+        return np.lib.format.open_memmap(self.run_path(run_id), mode='w+',
+                                         dtype=dtype, shape=self.shape)
+
+    def append(self, values, run_id=None):
+        """
+        Write the values of a replication, by default after the last one.
+
+        Returns
+        -------
+        run_id : int
+            Id of the written replication.
+        """
+        if run_id is None:
+            run_id = max(self.runs, default=-1) + 1
+
+        values = np.asarray(values)
+        if values.shape != self.shape:
+            raise ValueError(f"Expected values of shape {self.shape}, "
+                             f"got {values.shape}")
+
+        out = self.allocate(run_id, values.dtype)
+        out[:] = values
+        out.flush()
+
+        return run_id
+
+    def read(self, run_id):
+        """
+        Read-only memory map of the values of a single replication.
+        """
+        return np.load(self.run_path(run_id), mmap_mode='r')
+
+    def __getitem__(self, run_id):
+        """
+        A single replication as a DataFrame.
+        """
+        return pd.DataFrame(np.array(self.read(run_id)), index=self.index,
+                            columns=self.columns)
+
+    def frame(self, run_ids=None):
+        """
+        Stack replications into a single DataFrame with a (Run, Year, Month,
+        Day) index.
+
+        Parameters
+        ----------
+        run_ids : list of int, optional
+            Replications to read, by default all of them.
+        """
+        if run_ids is None:
+            run_ids = self.runs
+
+        n = len(run_ids)
+        # Keep the type the replications were stored in, e.g. float32
+        dtype = self.read(run_ids[0]).dtype if n else np.float64
+        values = np.empty((n * self.shape[0], self.shape[1]), dtype)
+        for i, r in enumerate(run_ids):
+            values[i * self.shape[0]: (i + 1) * self.shape[0]] = self.read(r)
+
+        # Repeat the index of a replication for each run
+        runs, run_codes = np.unique(run_ids, return_inverse=True)
+        index = pd.MultiIndex(
+            levels=[runs] + list(self.index.levels),
+            codes=[np.repeat(run_codes, self.shape[0])] +
+                  [np.tile(c, n) for c in self.index.codes],
+            names=['Run'] + list(self.index.names))
+
+        return pd.DataFrame(values, index=index, columns=self.columns)
@@ -1,12 +1,36 @@
 from netCDF4 import num2date, date2num
+from concurrent.futures import FIRST_COMPLETED, wait
+from contextlib import ExitStack
 from datetime import datetime
+from itertools import groupby
+import glob
+import hashlib
+import os
+import re
 import xarray as xr
 import pandas as pd
 import numpy as np
 
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
+
+from frameio import frameio
+from parallel import parallel
+
+# Mean radius of the Earth in km
+EARTH_RADIUS = 6371.0
+
+# Chunks of the data set when gathering grid cells, such that only the
+# latitude bands around the stations are read from each file
+GATHER_CHUNKS = {'lat': 8}
+
+# Time range at the end of CMIP file names, e.g. _20060101-20151231.nc
+TIME_RANGE = re.compile(r'_(\d{4,8})-(\d{4,8})\.nc$')
+
 
 def idw(file, varname, stations, extent=None, period=None,
-        alpha=2, k=4, **kwargs):
+        alpha=2, k=4, metric='euclidean', weights_dir=None, gather=False,
+        chunk_size=None, dtype=np.float64, after=None, **kwargs):
     """
     Extract inverse distance weighting interpolated time series from netcdf
     file for a list of stations.
@@ -38,6 +62,31 @@ def idw(file, varname, stations, extent=None, period=None,
         neighboring points of a given station.
     k : int, default 4
         Number of closest data points to use in the interpolation.
+    metric : {'euclidean', 'haversine'}, default 'euclidean'
+        Distance used to select and weight the closest data points. The
+        euclidean distance is taken in degrees of lat, lon while 'haversine'
+        uses the great-circle distance, which avoids distortion at high
+        latitudes.
+    weights_dir : str, optional
+        Folder in which to cache the interpolation weights. Weights are
+        looked up by a hash of the grid and stations so that subsequent calls
+        on the same grid skip the neighbor search.
+    gather : bool, default False
+        If True, only the k closest grid cells of each station are read from
+        the files rather than the whole extent, by opening them in bands of
+        `GATHER_CHUNKS` latitudes and reading only the bands holding those
+        cells. This reduces I/O and RAM usage for long records when the
+        stations cover a small part of the grid.
+    chunk_size : int, optional
+        Number of time steps to read and interpolate at a time. This bounds
+        the peak RAM usage when combining many files. See `iter_idw` to
+        write each block out as it is interpolated.
+    dtype : numpy dtype, default numpy.float64
+        Floating point type the data is read and interpolated in. Using
+        numpy.float32 halves the memory of each block and of the result.
+    after : tuple, optional
+        Only interpolate time steps after this `(year, month, day)`, e.g.
+        the last date of an existing output, see `idw_to_file`.
 
     Returns
     -------
@@ -50,36 +99,337 @@ def idw(file, varname, stations, extent=None, period=None,
     1. Ensure that the spatial extent is large enough to encapsulate all
        stations of interest.
     """
-    # Load the data
-    data, lat, lon, dates = load_data(file, varname, extent, period, **kwargs)
+    chunks = iter_idw(file, varname, stations, extent=extent, period=period,
+                      alpha=alpha, k=k, metric=metric,
+                      weights_dir=weights_dir,
+                      gather=gather, chunk_size=chunk_size, dtype=dtype,
+                      after=after, **kwargs)
+
+    return pd.concat(list(chunks))
+
+
+def iter_idw(file, varname, stations, extent=None, period=None,
+             alpha=2, k=4, metric='euclidean', weights_dir=None,
+             gather=False, chunk_size=None, dtype=np.float64, after=None,
+             cancel=None, **kwargs):
+    """
+    Generator version of `idw` that walks the time axis in blocks of
+    `chunk_size` time steps, yielding the interpolated result of each block.
+    Only one block of data is held in memory at a time, so results can be
+    written incrementally regardless of the length of the record. Parameters
+    are the same as for `idw`, along with an optional `cancel`
+    threading.Event which stops the iteration before the next block when
+    set.
+    """
+    # Open the data set over the extent and period of interest
+    chunks = GATHER_CHUNKS if gather else None
+    ds = open_data(file, extent, period, after=after, chunks=chunks,
+                   **kwargs)
+    lat = ds.lat.values
+    lon = ds.lon.values
 
     # Convert points tuple to array
     points = np.array(list(stations.values()))
 
     # Do the interpolation
-    interpolated = inv_dist(data, lat, lon, points, k=k, alpha=alpha)
+    if weights_dir:
+        weights = IDWWeights.cached(weights_dir, lat, lon, points, k, alpha,
+                                    metric)
+    else:
+        weights = IDWWeights(lat, lon, points, k=k, alpha=alpha,
+                             metric=metric)
+
+    n = ds.time.size
+    step = chunk_size or max(n, 1)
+
+    for t in range(0, max(n, 1), step):
+        if cancel is not None and cancel.is_set():
+            return
+
+        block = ds.isel(time=slice(t, t + step))
+
+        if gather:
+            # Only read the grid cells neighboring the stations
+            data, dates = load_cells(block, varname, weights.cells, dtype)
+            interpolated = weights.apply_cells(data, dtype)
+        else:
+            data, dates = load_grid(block, varname, dtype)
+            interpolated = weights.apply(data, dtype)
 
+        yield to_frame(interpolated, dates, varname, stations)
+
+
+def to_frame(interpolated, dates, varname, stations):
+    """
+    Put together the output DataFrame of interpolated station data.
+    """
     # Put together index and columns for output DataFrame
-    idx = pd.MultiIndex.from_tuples([(d.year, d.month, d.day) for d in dates])
-    col = pd.MultiIndex.from_tuples([(varname, s) for s in stations])
+    idx = pd.MultiIndex.from_tuples([(d.year, d.month, d.day) for d in dates],
+                                    names=['Y', 'M', 'D'])
+    col = pd.MultiIndex.from_tuples([(varname, s) for s in stations],
+                                    names=['Variable', 'Station'])
 
     result = pd.DataFrame(interpolated, index=idx, columns=col)
-    result.index.names = ['Y', 'M', 'D']
-    result.columns.names = ['Variable', 'Station']
 
     return result.sort_index(axis=1)
 
 
+def group_files(path, varname):
+    """
+    Find the netCDF files of a variable in a folder and group them by
+    everything but the date range at the end of the file name, such that each
+    group is a single model, scenario and run.
+
+    Returns
+    -------
+    groups : dict
+        Maps the name of each group to the list of its file paths.
+    """
+    files = sorted(fl for fl in os.listdir(path)
+                   if fl.endswith('.nc') and varname + '_' in fl)
+
+    def file_splitter(fname):
+        *first, _ = fname.split('_')
+        return '_'.join(first)
+
+    return {k: [os.path.join(path, g) for g in group]
+            for k, group in groupby(files, key=file_splitter)}
+
+
+def idw_to_file(fpath, file, varname, stations, incremental=False,
+                **kwargs):
+    """
+    Run `iter_idw` and write the result to a file in the format given by its
+    extension (see `frameio.read_frame`). CSV files are written block by
+    block as they are interpolated. Keyword arguments are passed on to
+    `iter_idw`.
+
+    If `incremental` is True and `fpath` already exists, only the files and
+    time steps after its last date are interpolated and appended to it, so
+    that an output can be brought up to date when new files are added to an
+    archive. Appending to a CSV file takes time proportional to the new data
+    only, while other formats are rewritten.
+    """
+    append = incremental and os.path.exists(fpath)
+
+    if append:
+        last = last_date(fpath)
+        if last:
+            file = files_after(file, last)
+            if not file:
+                return fpath
+            kwargs['after'] = last
+
+    chunks = iter_idw(file, varname, stations, **kwargs)
+
+    if frameio.frame_format(fpath) != '.csv':
+        # Nothing is interpolated if cancelled before the first block
+        chunks = list(chunks)
+        if append:
+            chunks.insert(0, frameio.read_frame(fpath))
+        if chunks:
+            frameio.write_frame(pd.concat(chunks), fpath)
+        return fpath
+
+    for i, df in enumerate(chunks):
+        if i == 0 and not append:
+            df.to_csv(fpath)
+        else:
+            df.to_csv(fpath, mode='a', header=False)
+
+    return fpath
+
+
+def last_date(fpath):
+    """
+    Get the last `(year, month, day)` of an output file, or None if it has
+    no data. Only the end of CSV files is read.
+    """
+    if frameio.frame_format(fpath) != '.csv':
+        index = frameio.read_frame(fpath).index
+        return tuple(int(v) for v in index[-1]) if len(index) else None
+
+    fields = last_line(fpath).split(',')[:3]
+
+    try:
+        return tuple(int(v) for v in fields)
+    except ValueError:
+        # Only the header has been written
+        return None
+
+
+def last_line(fpath, block_size=2**16):
+    """
+    Read the last non-empty line of a text file from its end.
+    """
+    with open(fpath, 'rb') as f:
+        end = f.seek(0, os.SEEK_END)
+        start = end
+
+        # Read back until the start of the last line is found
+        while start > 0:
+            start = max(start - block_size, 0)
+            f.seek(start)
+            lines = f.read(end - start).rstrip(b'\r\n').splitlines()
+            if len(lines) > 1 or start == 0:
+                return lines[-1].decode() if lines else ''
+
+    return ''
+
+
+def files_after(file, date):
+    """
+    Select the netCDF files that may contain time steps after a
+    `(year, month, day)`, using the time range at the end of CMIP file
+    names. Files without a time range in their name are kept.
+
+    Parameters
+    ----------
+    file : str or list
+        File path, wildcard pattern or list of file paths.
+    date : tuple
+        The `(year, month, day)` after which data is needed.
+
+    Returns
+    -------
+    files : list
+        The selected file paths.
+    """
+    if isinstance(file, str):
+        file = sorted(glob.glob(file)) if "*" in file else [file]
+
+    files = []
+    for f in file:
+        match = TIME_RANGE.search(os.path.basename(f))
+        if match:
+            end = match.group(2)
+            # Time ranges may be given by year or month only
+            end = (int(end[:4]), int(end[4:6] or 12), int(end[6:8] or 31))
+            if end <= tuple(date):
+                continue
+        files.append(f)
+
+    return files
+
+
+def idw_batch(groups, out, varname, stations, n_jobs=1, progress=None,
+              cancel=None, fmt='.csv', **kwargs):
+    """
+    Interpolate several independent groups of netCDF files, such as the
+    models, scenarios and runs of an ensemble, across a pool of processes.
+
+    Parameters
+    ----------
+    groups : dict
+        Maps the name of each group to its file path(s), as returned by
+        `group_files`. Each group is written to `idw_<name><fmt>` in `out`.
+    out : str
+        Output folder.
+    varname : str
+        Name of the variable in the netcdf file to be used.
+    stations : dict
+        Stations to interpolate to, see `idw`.
+    n_jobs : int, default 1
+        Number of worker processes. With 1 the groups are run in the current
+        process.
+    progress : callable, optional
+        Called with `(name, n_files)` as each group finishes, e.g. to update
+        a progress bar from another thread.
+    cancel : threading.Event, optional
+        When set, groups that have not started yet are skipped, and groups
+        being interpolated stop before their next block of `chunk_size` time
+        steps, leaving their output incomplete. Only finished groups are
+        returned and reported to `progress`.
+    fmt : str, default '.csv'
+        Extension of the output files, see `frameio.read_frame`.
+    **kwargs
+        Passed on to `idw_to_file` and `iter_idw`. Using `weights_dir` lets
+        all workers share the cached interpolation weights of a grid, and
+        with `incremental` existing outputs are only extended with the time
+        steps of new files, reusing those weights.
+
+    Returns
+    -------
+    paths : dict
+        Maps the name of each group to its output file.
+    """
+    paths = {}
+
+    def target(name):
+        return os.path.join(out, f"idw_{name}{fmt}")
+
+    def done(name, fpath):
+        paths[name] = fpath
+        if progress is not None:
+            files = groups[name]
+            progress(name, 1 if isinstance(files, str) else len(files))
+
+    def cancelled():
+        return cancel is not None and cancel.is_set()
+
+    if n_jobs == 1:
+        for name, files in groups.items():
+            if cancelled():
+                break
+            fpath = idw_to_file(target(name), files, varname, stations,
+                                cancel=cancel, **kwargs)
+            if cancelled():
+                break
+            done(name, fpath)
+        return paths
+
+    with ExitStack() as stack:
+        # Workers poll an event held by a manager process, which is set
+        # when `cancel` is
+        token = None
+        if cancel is not None:
+            token = stack.enter_context(parallel.manager()).Event()
+
+        pool = stack.enter_context(parallel.process_pool(n_jobs))
+        futures = {pool.submit(idw_to_file, target(name), files, varname,
+                               stations, cancel=token, **kwargs): name
+                   for name, files in groups.items()}
+
+        # Wait in short steps to pass a cancellation on to the workers
+        pending = set(futures)
+        while pending:
+            finished, pending = wait(pending, timeout=0.2,
+                                     return_when=FIRST_COMPLETED)
+            for future in finished:
+                done(futures[future], future.result())
+
+            if cancelled():
+                token.set()
+                pool.shutdown(cancel_futures=True)
+                break
+
+    return paths
+
+
 def load_data(file, varname, extent=None, period=None, **kwargs):
     """
     Loads netCDF files and extracts data given a spatial extend and time period
     of interest.
     """
+    ds = open_data(file, extent, period, **kwargs)
+    arr, dates = load_grid(ds, varname)
+
+    return arr, ds.lat.values, ds.lon.values, dates
+
+
+def open_data(file, extent=None, period=None, after=None, chunks=None,
+              **kwargs):
+    """
+    Opens netCDF files and selects the spatial extent and time period of
+    interest, optionally only after a `(year, month, day)`, without reading
+    any of the data. The data is read in dask `chunks` if given, otherwise a
+    multi-file data set has one chunk per file.
+    """
     # Open either single or multi-file data set depending if list of wildcard
     if "*" in file or isinstance(file, list):
-        ds = xr.open_mfdataset(file, decode_times=False)
+        ds = xr.open_mfdataset(file, decode_times=False, chunks=chunks)
     else:
-        ds = xr.open_dataset(file, decode_times=False)
+        ds = xr.open_dataset(file, decode_times=False, chunks=chunks)
 
     # Construct condition based on spatial extents
     if extent:
@@ -97,72 +447,381 @@ def load_data(file, varname, extent=None, period=None, **kwargs):
         t2 = date2num(datetime(*period[1]), ds.time.units, ds.time.calendar)
         ds = ds.sel(time=(ds.time >= t1) & (ds.time <= t2))
 
+    # Only keep time steps on days after a date, whatever their time of day
+    if after:
+        dates = num2date(ds.time.values, ds.time.units, ds.time.calendar)
+        keep = [(d.year, d.month, d.day) > tuple(after) for d in dates]
+        ds = ds.isel(time=np.flatnonzero(keep))
+
     # Extra keyword arguments to select from additional dimensions (e.g. plev)
     if kwargs:
         ds = ds.sel(**kwargs)
 
-    # Load in the data to a numpy array
+    return ds
+
+
+def load_grid(ds, varname, dtype=np.float64):
+    """
+    Reads all grid cells of a variable into a numpy array of shape (n, l, m)
+    and type `dtype` along with the dates of each time step.
+    """
     dates = num2date(ds.time, ds.time.units, ds.time.calendar)
-    arr = ds[varname].values
-    lat = ds.lat.values
-    lon = ds.lon.values
+    arr = ds[varname].values.astype(dtype, copy=False)
+    arr = convert_units(arr, ds[varname].units)
+
+    return arr, dates
+
+
+def load_cells(ds, varname, cells, dtype=np.float64):
+    """
+    Reads only the given grid cells of a variable using pointwise indexing.
+    With a data set opened in chunks (see `GATHER_CHUNKS`), only the chunks
+    holding the cells are read. Otherwise the rows of the cells are read
+    whole, as pointwise reads of a netCDF file are slow.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        Data set returned by `open_data`.
+    varname : str
+        Name of the variable in the netcdf file to be used.
+    cells : ndarray
+        Flat indices of the grid cells to read from a grid of shape (l, m).
+    dtype : numpy dtype, default numpy.float64
+        Floating point type of the returned data.
+
+    Returns
+    -------
+    arr : ndarray
+        Data of the selected cells with shape (n, c).
+    dates : ndarray
+        Date of each time step.
+    """
+    i, j = np.unravel_index(cells, (ds.lat.size, ds.lon.size))
+    da = ds[varname].transpose('time', 'lat', 'lon')
+
+    if da.chunks is not None:
+        arr = da.isel(lat=xr.DataArray(i, dims='cell'),
+                      lon=xr.DataArray(j, dims='cell')).values
+    else:
+        rows, row = np.unique(i, return_inverse=True)
+        arr = da.isel(lat=rows).values[:, row, j]
+
+    dates = num2date(ds.time, ds.time.units, ds.time.calendar)
+    arr = convert_units(arr.astype(dtype, copy=False), da.units)
+
+    return arr, dates
 
+
+def convert_units(arr, units):
+    """
+    Converts pr to mm/day and tas to degC.
+    """
     # Convert pr units to mm/day
-    if ds[varname].units == 'kg m-2 s-1':
+    if units == 'kg m-2 s-1':
         arr *= 86400
     # Convert tas units to degK
-    elif ds[varname].units == 'K':
+    elif units == 'K':
         arr -= 273.15
 
-    return arr, lat, lon, dates
+    return arr
 
 
-def inv_dist(data, lat, lon, points, k=4, alpha=2):
+def inv_dist(data, lat, lon, points, k=4, alpha=2, metric='euclidean',
+             dtype=np.float64):
     """
     Inverse distance point interpolation function from grid.
 
     Parameters
     ----------
     data : ndarray
-        array of data with shape (n, m, l).
+        array of data with shape (n, l, m).
     lat : ndarray
         latitude array of shape (l,).
     lon : ndarray
         longitude array of shape (m,).
     points : ndarray
-        array consisting of lon,lat points with shape (q, 2).
+        array consisting of lat,lon points with shape (q, 2).
     k : int, default 4
         p closest points to use in inverse distance calculation.
     alpha : float, default 2
         coefficient with which to calculate the inverse distance of the
         neighboring points of a given station.
+    metric : {'euclidean', 'haversine'}, default 'euclidean'
+        Distance in degrees or great-circle distance, see `nearest_cells`.
+    dtype : numpy dtype, default numpy.float64
+        Floating point type of the result.
 
     Returns
     -------
     result : ndarray
         interpolated result of shape (n, q).
     """
-    n, m, l = data.shape
-    # Pre-allocate memory to resulting array
-    result = np.zeros((n, points.shape[0]))
+    weights = IDWWeights(lat, lon, points, k=k, alpha=alpha, metric=metric)
+    return weights.apply(data, dtype)
+
+
+def nearest_cells(lat, lon, points, k=4, metric='euclidean'):
+    """
+    Find the k closest grid cells to each point using a KD-tree built over
+    the lat, lon grid.
+
+    Parameters
+    ----------
+    lat : ndarray
+        latitude array of shape (l,).
+    lon : ndarray
+        longitude array of shape (m,).
+    points : ndarray
+        array consisting of lat,lon points with shape (q, 2).
+    k : int, default 4
+        Number of closest grid cells to find for each point.
+    metric : {'euclidean', 'haversine'}, default 'euclidean'
+        With 'euclidean' distances are measured in degrees of lat, lon. With
+        'haversine' the great-circle distance in km is used.
+
+    Returns
+    -------
+    dist : ndarray
+        Distance to each of the closest grid cells with shape (q, k), sorted
+        in ascending order.
+    idx : ndarray
+        Flat index of each of the closest grid cells into a grid of shape
+        (l, m) with shape (q, k).
+
+    Notes
+    -----
+    1. Longitude is treated as periodic so that grids and stations on either
+       side of Greenwich are neighbors.
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+
+    if k > lat.size * lon.size:
+        raise ValueError(f"k={k} is larger than the number of grid cells")
 
     # Get lon, lat grid
     xx, yy = np.meshgrid(lon, lat)
 
-    for q, (x0, y0) in enumerate(points):
-        # Calculate distance of each grid point
-        dist = np.sqrt((xx - x0)**2 + (yy - y0)**2)
+    if metric == 'haversine':
+        # Nearest neighbors by chord length on the unit sphere are also
+        # nearest by great-circle distance, which is recovered afterwards
+        grid = unit_vectors(yy.ravel(), xx.ravel())
+        pts = unit_vectors(points[:, 0], points[:, 1])
 
-        # Rank distances for each point
-        rank = np.argsort(dist, axis=None).reshape(m, l)
+        chord, idx = cKDTree(grid).query(pts, k=k)
+        dist = 2 * EARTH_RADIUS * np.arcsin(np.minimum(chord / 2, 1))
 
-        # Mask for k closest points
-        ma = rank > (rank.max() - k)
+        return dist.reshape(-1, k), idx.reshape(-1, k)
 
-        # Calculate weighting of each of the grid points
-        weights = dist[ma]**-alpha / np.sum(dist[ma]**-alpha)
+    elif metric != 'euclidean':
+        raise ValueError(f"Unknown metric {metric!r}")
 
-        # Get the interpolated result
-        result[:, q] = data[:, ma] @ weights
+    # Map grid and points to a torus of 360 degrees on both axes. Latitude is
+    # shifted to be positive and never spans more than half of the box, so
+    # only longitude is effectively wrapped around.
+    grid = np.column_stack([xx.ravel() % 360, yy.ravel() + 90])
+    pts = np.column_stack([points[:, 1] % 360, points[:, 0] + 90])
+
+    tree = cKDTree(grid, boxsize=360)
+    dist, idx = tree.query(pts, k=k)
+
+    return dist.reshape(-1, k), idx.reshape(-1, k)
+
+
+def unit_vectors(lat, lon):
+    """
+    Convert lat, lon in degrees to cartesian points on the unit sphere with
+    shape (q, 3).
+    """
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+
+    return np.column_stack([np.cos(lat) * np.cos(lon),
+                            np.cos(lat) * np.sin(lon),
+                            np.sin(lat)])
+
+
+def inverse_weights(dist, alpha=2):
+    """
+    Calculate normalized inverse distance weights.
+
+    Parameters
+    ----------
+    dist : ndarray
+        Distances to the neighboring grid cells with shape (q, k).
+    alpha : float, default 2
+        coefficient with which to calculate the inverse distance of the
+        neighboring points of a given station.
+
+    Returns
+    -------
+    weights : ndarray
+        Weights of shape (q, k) summing to 1 along each row. Points falling
+        exactly on a grid cell take the value of that cell alone.
+    """
+    with np.errstate(divide='ignore'):
+        inv = dist ** -float(alpha)
+
+    # Points coinciding with a grid cell would otherwise get infinite weights
+    exact = np.isinf(inv)
+    on_grid = exact.any(axis=1)
+    inv[on_grid] = exact[on_grid]
+
+    return inv / inv.sum(axis=1, keepdims=True)
+
+
+class IDWWeights:
+    def __init__(self, lat, lon, points, k=4, alpha=2, metric='euclidean'):
+        """
+        Sparse inverse distance weight matrix mapping the cells of a lat, lon
+        grid to a set of points. Building the matrix does the neighbor search
+        once, after which it can be applied to any data on the same grid.
+
+        Parameters
+        ----------
+        lat : ndarray
+            latitude array of shape (l,).
+        lon : ndarray
+            longitude array of shape (m,).
+        points : ndarray
+            array consisting of lat,lon points with shape (q, 2).
+        k : int, default 4
+            p closest points to use in inverse distance calculation.
+        alpha : float, default 2
+            coefficient with which to calculate the inverse distance of the
+            neighboring points of a given station.
+        metric : {'euclidean', 'haversine'}, default 'euclidean'
+            Distance in degrees or great-circle distance, see
+            `nearest_cells`.
+        """
+        self.lat = np.asarray(lat, dtype=float)
+        self.lon = np.asarray(lon, dtype=float)
+        self.points = np.asarray(points, dtype=float).reshape(-1, 2)
+        self.k = k
+        self.alpha = alpha
+        self.metric = metric
+        self.key = weights_key(self.lat, self.lon, self.points, k, alpha,
+                               metric)
+
+        # Find the k closest grid cells of all points in a single query
+        dist, idx = nearest_cells(self.lat, self.lon, self.points, k=k,
+                                  metric=metric)
+
+        # Calculate weighting of each of the grid cells
+        weights = inverse_weights(dist, alpha=alpha)
+
+        # One row per point with k non-zero entries each
+        q = self.points.shape[0]
+        self.matrix = csr_matrix((weights.ravel(), idx.ravel(),
+                                  np.arange(0, q * k + 1, k)),
+                                 shape=(q, self.lat.size * self.lon.size))
+
+    def apply(self, data, dtype=np.float64):
+        """
+        Interpolate gridded data to the points.
+
+        Parameters
+        ----------
+        data : ndarray
+            array of data with shape (n, l, m).
+        dtype : numpy dtype, default numpy.float64
+            Floating point type the interpolation is computed in.
+
+        Returns
+        -------
+        result : ndarray
+            interpolated result of shape (n, q).
+        """
+        n = data.shape[0]
+        data = data.reshape(n, self.matrix.shape[1]).astype(dtype, copy=False)
+        return (self.matrix.astype(dtype) @ data.T).T
+
+    @property
+    def cells(self):
+        """
+        Sorted flat indices of the grid cells used by at least one point.
+        """
+        return np.unique(self.matrix.indices)
+
+    def apply_cells(self, data, dtype=np.float64):
+        """
+        Interpolate data read only for the grid cells in `cells`.
+
+        Parameters
+        ----------
+        data : ndarray
+            array of data with shape (n, c), where c is the size of `cells`.
+        dtype : numpy dtype, default numpy.float64
+            Floating point type the interpolation is computed in.
+
+        Returns
+        -------
+        result : ndarray
+            interpolated result of shape (n, q).
+        """
+        matrix = self.matrix[:, self.cells].astype(dtype)
+        return (matrix @ data.astype(dtype, copy=False).T).T
+
+    def save(self, path):
+        """
+        Save the weights to a `.npz` file.
+        """
+        np.savez(path, lat=self.lat, lon=self.lon, points=self.points,
+                 k=self.k, alpha=self.alpha, metric=self.metric,
+                 data=self.matrix.data,
+                 indices=self.matrix.indices, indptr=self.matrix.indptr,
+                 shape=self.matrix.shape)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load weights previously written with `IDWWeights.save`.
+        """
+        with np.load(path) as f:
+            weights = cls.__new__(cls)
+            weights.lat = f['lat']
+            weights.lon = f['lon']
+            weights.points = f['points']
+            weights.k = int(f['k'])
+            weights.alpha = f['alpha'].item()
+            weights.metric = str(f['metric'])
+            weights.matrix = csr_matrix((f['data'], f['indices'], f['indptr']),
+                                        shape=tuple(f['shape']))
+
+        weights.key = weights_key(weights.lat, weights.lon, weights.points,
+                                  weights.k, weights.alpha, weights.metric)
+        return weights
+
+    @classmethod
+    def cached(cls, folder, lat, lon, points, k=4, alpha=2,
+               metric='euclidean'):
+        """
+        Load weights for the given grid and points from `folder`, building
+        and saving them first if they have not been cached yet.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        key = weights_key(lat, lon, points, k, alpha, metric)
+        path = os.path.join(folder, f"idw_{key}.npz")
+
+        if os.path.exists(path):
+            return cls.load(path)
+
+        weights = cls(lat, lon, points, k=k, alpha=alpha, metric=metric)
+        os.makedirs(folder, exist_ok=True)
+
+        frameio.write_atomic(path, weights.save)
+
+        return weights
+
+
+def weights_key(lat, lon, points, k, alpha, metric='euclidean'):
+    """
+    Hash identifying the weights of a grid, set of points, k, alpha and
+    metric.
+    """
+    h = hashlib.sha1()
+    for arr in (lat, lon, points):
+        h.update(np.ascontiguousarray(arr, dtype=float).tobytes())
+    h.update(f"{k}:{float(alpha)}:{metric}".encode())
 
-    return result
+    return h.hexdigest()
@@ -1,16 +1,21 @@
+import pickle
+
 import pandas as pd
 import numpy as np
 
 from numba import njit
 
+from parallel import parallel
+
 
 class KNN:
-    def __init__(self, X, P, w=14, B=10, interp=0.9):
+    def __init__(self, X, P, w=14, B=10, interp=0.9, dtype=np.float64,
+                 distance='euclidean'):
         """
         Function to idw_run the KNN Weather Generator algorithm. Adapted from
         King et al. (2012) to use euclidean distance for L nearest neighbor
-        selection as opposed to mahalanobis distance along 1st principal
-        component.
+        selection by default, with the original mahalanobis distance along
+        1st principal component available as an option.
 
         Parameters
         ----------
@@ -28,6 +33,17 @@ class KNN:
         interp: float
             Level of influence of perturbation to be applied. 1 represents full
             perturbation while 0 represents no perturbation.
+        dtype: numpy dtype, default numpy.float64
+            Floating point type of the data, variances and replications. Using
+            numpy.float32 halves the memory of each replication.
+        distance: {'euclidean', 'mahalanobis'}, default 'euclidean'
+            Distance between days used to select the K nearest neighbors.
+            * euclidean - Euclidean distance between the standardized means
+              of each variable.
+            * mahalanobis - Mahalanobis distance along the 1st principal
+              component of the standardized means of each variable, as in
+              King et al. (2012). The projection is computed once, so that
+              the distance between days is a scalar difference.
 
         Returns
         -------
@@ -36,16 +52,34 @@ class KNN:
             as `X` and length equal to `runs` multiplied by that of `X`.
 
         """
-        self.X = X
+        self.dtype = np.dtype(dtype)
+        # Only copy the input data if it is not of the requested type
+        if (X.dtypes != self.dtype).any():
+            X = X.astype(self.dtype)
+
+        # Kernels are compiled for row-major data, and blocks of rows are
+        # copied faster from it. Frames joined from several variables are
+        # column-major, so they are copied once here rather than for each
+        # replication, and X shares the row-major values.
+        self.values = np.ascontiguousarray(X.values)
+        self.X = pd.DataFrame(self.values, X.index, X.columns, copy=False)
         self.P = P
         self.w = w
         self.B = B
         self.interp = interp
 
-        # Standardize columns of input data
-        self.Xn = (X - X.mean()) / X.std()
-        # Group columns of like variables
-        self.Xt = self.Xn.groupby(level=0, axis=1).mean()
+        # Standardize columns of input data and group columns of like
+        # variables, without keeping the standardized copy of all columns
+        self.Xt = ((X - X.mean()) / X.std()).groupby(level=0, axis=1).mean()
+
+        # Project the data used to measure distance between days
+        if distance == 'mahalanobis':
+            self.Xd = first_pc(self.Xt.values)
+        elif distance == 'euclidean':
+            self.Xd = self.Xt.values
+        else:
+            raise ValueError(f"Unknown distance {distance!r}")
+        self.distance = distance
         # Get year, month, and day from index
         year, mon, day = np.array(list(zip(*X.index.values)), dtype=np.uint32)
 
@@ -55,76 +89,237 @@ class KNN:
         # Get day of year for all days
         self.doy = day_of_year(mon, day)
 
-    def bootstrap(self, run_id):
-        Xt = self.Xt.values
-        X = self.X.values
-
-        n, m = self.X.shape
-        # Pre-allocate results array
-        Xsim = np.zeros((n, m))
-
         # Determine K
-        N = np.sum(self.doy == self.doy[0])
-        L = N * (self.w + 1) - 1
-        K = int(round(np.sqrt(L)))
+        self.N = np.sum(self.doy == self.doy[0])
+        self.L = self.N * (self.w + 1) - 1
+        self.K = int(round(np.sqrt(self.L)))
 
         # Get L nearest neighbors indices for each day of the year
-        lp1nn_idx = lnn_algorithm(self.doy, self.w, L)
+        self.lp1nn_idx = lnn_algorithm(self.doy, self.w, self.L)
+
+        # Get K nearest neighbors indices for each day
+        self.knn_idx = knn_algorithm(self.Xd, self.doy, self.lp1nn_idx,
+                                     self.K)
+
+        # Get variance of the K and L nearest neighbors of each day used
+        # for perturbation
+        values = self.values.astype(np.float64, copy=False)
+        self.knn_var = knn_variance(values, self.knn_idx).astype(self.dtype)
+        self.lnn_var = lnn_variance(values, self.doy,
+                                    self.lp1nn_idx).astype(self.dtype)
 
         # Generate cumulative probability distribution
-        pn = (np.ones(K) / np.arange(1, K + 1)).cumsum()
-        pn /= pn.max()
+        self.pn = (np.ones(self.K) / np.arange(1, self.K + 1)).cumsum()
+        self.pn /= self.pn.max()
+
+    def save(self, path):
+        """
+        Save the fitted generator to a file so that it can be reloaded with
+        `KNN.load` without refitting.
+        """
+        with open(path, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path):
+        """
+        Load a generator saved with `KNN.save`.
+        """
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def bootstrap_many(self, runs, n_jobs=1, seed=None, store=None,
+                       progress=None, cancel=None):
+        """
+        Generate several independent replications, spread across a pool of
+        processes.
+
+        Parameters
+        ----------
+        runs : int
+            Number of replications to generate.
+        n_jobs : int, default 1
+            Number of worker processes. With 1 the replications are generated
+            in the current process.
+        seed : int or numpy.random.SeedSequence, optional
+            Seed from which an independent random stream is spawned for each
+            replication, keyed by its run id. Results are reproducible for a
+            given seed, regardless of the number of workers, and runs
+            appended to a store with the same seed differ from earlier ones.
+        store : frameio.ReplicationStore, optional
+            Store to stream the raw replications into as they are generated,
+            instead of returning them in a single DataFrame. The run ids follow
+            on from the replications already in the store.
+        progress : callable, optional
+            Called with the run id as each replication finishes, when
+            generated in the current process.
+        cancel : threading.Event, optional
+            When set, no more replications are started in the current
+            process, and only those generated so far are returned.
+
+        Returns
+        -------
+        result: pandas.DataFrame or frameio.ReplicationStore
+            All replications stacked along the rows, with a `Run` index level,
+            or `store` if given.
+        """
+        run_ids = np.arange(runs)
+
+        if store is not None:
+            run_ids += max(store.runs, default=-1) + 1
+
+        # Child streams are keyed by run id, as with SeedSequence.spawn, so
+        # that the streams of appended runs follow on from earlier ones
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        seeds = [np.random.SeedSequence(seed.entropy,
+                                        spawn_key=seed.spawn_key + (int(r),),
+                                        pool_size=seed.pool_size)
+                 for r in run_ids]
+
+        if n_jobs == 1:
+            results = self.bootstrap_runs(run_ids, seeds, store, progress,
+                                          cancel)
+        else:
+            # Send each worker a contiguous share of runs
+            shares = np.array_split(np.arange(runs), n_jobs)
+
+            with parallel.process_pool(n_jobs) as pool:
+                futures = [pool.submit(self.bootstrap_runs, run_ids[idx],
+                                       [seeds[i] for i in idx], store)
+                           for idx in shares if len(idx)]
+                results = [df for f in futures for df in f.result()]
+
+        if store is not None:
+            return store
+
+        # Cancelled before the first replication
+        if not results:
+            index = pd.MultiIndex.from_arrays(
+                [[]] * 4, names=['Run', 'Year', 'Month', 'Day'])
+            return pd.DataFrame(index=index, columns=self.X.columns,
+                                dtype=self.dtype)
+
+        return pd.concat(results)
+
+    def bootstrap_runs(self, run_ids, seeds, store=None, progress=None,
+                       cancel=None):
+        """
+        Generate a replication for each run id using its own random stream
+        created from the corresponding seed. If a store is given, the
+        replications are written to it and an empty list is returned. See
+        `bootstrap_many` for `progress` and `cancel`.
+        """
+        results = []
+
+        for r, s in zip(run_ids, seeds):
+            if cancel is not None and cancel.is_set():
+                break
+
+            rng = np.random.default_rng(s)
+
+            if store is None:
+                results.append(self.bootstrap(r, rng))
+            else:
+                out = store.allocate(r, self.dtype)
+                self.simulate(rng, out)
+                out.flush()
+
+            if progress is not None:
+                progress(r)
+
+        return results
+
+    def sample(self, rng):
+        """
+        Draw the random numbers needed for one replication in bulk.
+
+        Parameters
+        ----------
+        rng: numpy.random.Generator
+            Random number generator.
+
+        Returns
+        -------
+        start: int
+            Index of the first day.
+        side: ndarray
+            -1 or 1 for each block, selecting the day before or after when a
+            block starts on a leap day.
+        nn: ndarray
+            Rank of the K nearest neighbor drawn for each block, sampled by
+            inverse transform of the cumulative distribution `pn`.
+        z: ndarray
+            Standard normal variates for perturbation of shape (n, m + 1).
+            The last column is shared by all log-normal variables of a day.
+        """
+        n, m = self.X.shape
+        blocks = len(range(self.B, n, self.B))
+
+        u = rng.random(1 + 2 * blocks)
+        z = rng.standard_normal((n, m + 1), dtype=self.dtype)
 
         # Random selection of the first day
         day1_idx, = np.where(self.doy == self.doy[0])
+        start = day1_idx[int(u[0] * day1_idx.size)]
 
-        start = np.random.choice(day1_idx)
+        # Randomly select the day before or after leap day
+        side = np.where(u[1: blocks + 1] < 0.5, -1, 1)
 
-        Xsim[:self.B] = X[start: start+self.B]
+        # Randomly draw K nearest neighbor from distribution
+        nn = np.searchsorted(self.pn, u[blocks + 1:], side='right')
 
-        # Loop through each block of size B
-        for i in range(self.B, n, self.B):
-            # Randomly select the day before or after leap day
-            if self.doy[i] < 0:
-                t = i + np.random.choice([-1, 1])
-            else:
-                t = i
+        return start, side, nn, z
 
-            # Get L + 1 nearest neighbors for current day of the year
-            lp1nn_t = lp1nn_idx[self.doy[t]]
+    def simulate(self, rng=None, out=None):
+        """
+        Generate the raw values of a single replication.
 
-            # Remove current day from L + 1 nearest neighbor indices
-            lnn_idx = lp1nn_t[lp1nn_t != t]
+        Parameters
+        ----------
+        rng: numpy.random.Generator or int, optional
+            Random number generator, or a seed to create one from.
+        out: ndarray, optional
+            Array of the same shape as `X` to write the replication into, such
+            as a memory map from `frameio.ReplicationStore.allocate`.
 
-            # Get euclidean distance of current day from L nearest neighbours
-            dist = np.linalg.norm(Xt[lnn_idx] - Xt[t], axis=1)
+        Returns
+        -------
+        Xsim: ndarray
+            The replication, `out` if given.
+        """
+        rng = np.random.default_rng(rng)
 
-            # Take the K nearest neighbours
-            knn_idx = lnn_idx[dist.argsort()][:K]
+        # Pre-allocate results array
+        Xsim = np.zeros(self.X.shape, self.dtype) if out is None else out
 
-            # Randomly draw K nearest neighbor from distribution
-            nn = (abs(pn - np.random.rand())).argmin()
+        # Draw all random numbers of the replication up front
+        start, side, nn, z = self.sample(rng)
 
-            # Set starting index of sampled block
-            j = knn_idx[nn]
+        resample(self.values, Xsim, self.doy, start, side, nn, z, self.knn_idx,
+                 self.knn_var, self.lnn_var, self.P, self.B, self.interp)
 
-            # Adjust block size if at end of input series
-            B = n - i if i + self.B > n else self.B
-            # Adjust selected block if at end of series
-            j = n - B if j + B > n else j
+        return Xsim
 
-            # Obtain K and L nearest neighbors for non-spatially averaged data
-            X_knn = X[knn_idx]
-            X_lnn = X[lnn_idx]
+    def bootstrap(self, run_id, rng=None):
+        """
+        Generate a single replication.
 
-            # Apply perturbation for each day in block for each variable
-            Xsim[i: i+B] = perturb(X[j: j+B].copy(),
-                                   X_knn,
-                                   X_lnn,
-                                   self.P,
-                                   self.interp)
+        Parameters
+        ----------
+        run_id: int
+            Value of the `Run` index level of the result.
+        rng: numpy.random.Generator or int, optional
+            Random number generator, or a seed to create one from.
+
+        Returns
+        -------
+        result: pandas.DataFrame
+            The replication with the same shape as `X`.
+        """
+        Xsim = self.simulate(rng)
 
-        df = pd.DataFrame(Xsim, self.X.index, self.Xn.columns)
+        df = pd.DataFrame(Xsim, self.X.index, self.X.columns)
         df['Run'] = run_id
         df.set_index('Run', append=True, inplace=True)
         df = df.reorder_levels(['Run', 'Year', 'Month', 'Day'])
@@ -132,28 +327,79 @@ class KNN:
         return df
 
 
-@njit
-def perturb(A, knn, lnn, P, interp):
+def warm_up():
+    """
+    Compile the numba kernels by fitting a generator to a small random
+    dataset and generating a replication. Compiled kernels are cached on
+    disk, so that this is only slow the first time, after which it loads
+    the kernels before the first run of a model, e.g. in a background
+    thread.
+    """
+    dates = pd.date_range('2001-01-01', '2002-12-31')
+    index = pd.MultiIndex.from_arrays([dates.year, dates.month, dates.day],
+                                      names=['Year', 'Month', 'Day'])
+    columns = pd.MultiIndex.from_tuples([('pr', 'S'), ('tas', 'S')],
+                                        names=['Variable', 'Station'])
+
+    X = pd.DataFrame(np.random.default_rng(0).random((dates.size, 2)),
+                     index=index, columns=columns)
+
+    KNN(X, np.array([2, 1], np.uint8)).bootstrap(0, 0)
+
+
+@njit(cache=True)
+def resample(X, Xsim, doy, start, side, nn, z, knn_idx, knn_var, lnn_var, P,
+             B, interp):
+    """
+    Block bootstrap resampling kernel filling `Xsim` with a replication of
+    `X` from the random numbers drawn by `KNN.sample`.
+    """
+    n = X.shape[0]
+
+    Xsim[:B] = X[start: start+B]
+
+    # Loop through each block of size B
+    for k, i in enumerate(range(B, n, B)):
+        # Take the day before or after leap day
+        if doy[i] < 0:
+            t = i + side[k]
+        else:
+            t = i
+
+        # Set starting index of sampled block from the K nearest neighbors
+        j = knn_idx[t, nn[k]]
+
+        # Adjust block size if at end of input series
+        b = n - i if i + B > n else B
+        # Adjust selected block if at end of series
+        j = n - b if j + b > n else j
+
+        # Copy block and apply perturbation for each day for each variable
+        Xsim[i: i+b] = X[j: j+b]
+        perturb(Xsim[i: i+b], z[i: i+b], knn_var[t], lnn_var[t], P, interp)
+
+
+@njit(cache=True)
+def perturb(A, z, knn_var, lnn_var, P, interp):
     n, m = A.shape
     # Go through each day in block
     for i in range(n):
-        z = np.random.randn()
         # Go through each variable in day
         for j in range(m):
             # Calculate random variate
             if P[j] == 0:
                 continue
             elif P[j] == 1:
-                std_knn = np.sqrt(var_i(knn, j))
-                z_j = np.random.normal(A[i, j], std_knn)
+                std_knn = np.sqrt(knn_var[j])
+                z_j = A[i, j] + std_knn * z[i, j]
             else:
                 if A[i, j] < 0.001:
                     continue
                 else:
-                    var_lnn = var_i_nonzero(lnn, j)
+                    var_lnn = lnn_var[j]
                     bm = np.sqrt(np.log10(var_lnn / A[i, j] + 1))
                     am = np.log10(A[i, j]) - 0.5 * bm
-                    z_j = np.exp(am + bm * z)
+                    z_j = np.exp(am + bm * z[i, m])
             # Apply perturbation
             A[i, j] = interp * A[i, j] + (1 - interp) * z_j
 
@@ -207,7 +453,83 @@ def lnn_algorithm(doy, w, L):
     return lnnp1
 
 
-@njit
+def knn_algorithm(Xt, doy, lp1nn_idx, K):
+    """
+    Function to obtain the indices of the K nearest neighbors of every day,
+    ordered by the distance from that day, out of its L nearest neighbors.
+    Days sharing a day of year are handled together.
+
+    Parameters
+    ----------
+    Xt : ndarray
+        Array of shape (n, v) of the spatially averaged standardized data
+        used to measure euclidean distance between days, or of shape (n,)
+        for the absolute difference, e.g. of 1st principal component scores
+        from `first_pc`.
+    doy : ndarray
+        An array consisting of the day of year for all data points, with
+        February 29th marked as a negative number.
+    lp1nn_idx : ndarray
+        Indices of the L + 1 nearest neighbors for each day of the year, as
+        returned by `lnn_algorithm`.
+    K : int
+        The value of K.
+
+    Returns
+    -------
+    knn : ndarray
+        Output of shape (n, K) corresponding to the indices of the K nearest
+        neighbors of each day. Rows of February 29th are set to -1 as their
+        neighbors are taken from the day before or after.
+    """
+    knn = np.full((doy.size, K), -1, dtype=np.int64)
+
+    for i in range(365):
+        days, = np.where(doy == i)
+        lp1nn = lp1nn_idx[i].astype(np.int64)
+
+        # Get distance of each day from its L + 1 nearest neighbors
+        if Xt.ndim == 1:
+            dist = np.abs(Xt[days, None] - Xt[lp1nn])
+        else:
+            dist = np.linalg.norm(Xt[days, None] - Xt[lp1nn], axis=2)
+
+        # Remove current day from its own neighbors
+        dist[days[:, None] == lp1nn] = np.inf
+
+        # Take the K nearest neighbours and order them by distance
+        part = np.argpartition(dist, K - 1, axis=1)[:, :K]
+        order = np.take_along_axis(dist, part, axis=1).argsort(axis=1)
+        knn[days] = lp1nn[np.take_along_axis(part, order, axis=1)]
+
+    return knn
+
+
+def first_pc(Xt):
+    """
+    Project data onto its 1st principal component, scaled by the standard
+    deviation of the component so that the absolute difference between two
+    days is their mahalanobis distance along the component.
+
+    Parameters
+    ----------
+    Xt : ndarray
+        Array of shape (n, v) of the spatially averaged standardized data.
+
+    Returns
+    -------
+    pc : ndarray
+        1st principal component score of each day with shape (n,).
+    """
+    Xc = Xt - Xt.mean(axis=0)
+
+    # Eigenvalues of the covariance matrix are in ascending order
+    var, vec = np.linalg.eigh(np.atleast_2d(np.cov(Xc, rowvar=False)))
+
+    return Xc @ vec[:, -1] / np.sqrt(var[-1])
+
+
+@njit(cache=True)
 def day_of_year(mon, day):
     doy = np.zeros(day.size, dtype=np.int32)
     count = 0
@@ -221,7 +543,7 @@ def day_of_year(mon, day):
     return doy
 
 
-@njit
+@njit(cache=True)
 def var_i(arr, j):
     n = arr.shape[0]
     sum_i = 0
@@ -235,17 +557,71 @@ def var_i(arr, j):
     return var
 
 
-@njit
-def var_i_nonzero(arr, j):
-    n = arr.shape[0]
-    sum_i = 0
-    for i in range(n):
-        if arr[i, j] >= 0.001:
-            sum_i += arr[i, j]
-    mean_i = sum_i / n
-    var = 0
-    for i in range(n):
-        if arr[i, j] >= 0.001:
-            var += (arr[i, j] - mean_i) ** 2
+@njit(cache=True)
+def knn_variance(X, knn_idx):
+    """
+    Variance of each column of `X` over the K nearest neighbors of each day,
+    as used for normal perturbation. Returns an array of shape (n, m).
+    """
+    n, m = X.shape
+    var = np.zeros((n, m))
+
+    for t in range(n):
+        if knn_idx[t, 0] < 0:
+            continue
+
+        knn = X[knn_idx[t]]
+        for j in range(m):
+            var[t, j] = var_i(knn, j)
+
+    return var
+
+
+@njit(cache=True)
+def lnn_variance(X, doy, lp1nn_idx):
+    """
+    Variance of the non-zero values of each column of `X` over the L nearest
+    neighbors of each day, as used for log-normal perturbation. Sums over
+    the L + 1 nearest neighbors are shared by all days of the same day of
+    year, and the current day is removed from them. Returns an array of
+    shape (n, m).
+    """
+    n, m = X.shape
+    L = lp1nn_idx.shape[1] - 1
+
+    # Sum, sum of squares and count of non-zero values by day of year
+    s1 = np.zeros((365, m))
+    s2 = np.zeros((365, m))
+    c = np.zeros((365, m))
+
+    for d in range(365):
+        for k in lp1nn_idx[d]:
+            for j in range(m):
+                if X[k, j] >= 0.001:
+                    s1[d, j] += X[k, j]
+                    s2[d, j] += X[k, j] ** 2
+                    c[d, j] += 1
+
+    var = np.zeros((n, m))
+
+    for t in range(n):
+        d = doy[t]
+        if d < 0:
+            continue
+
+        for j in range(m):
+            sum_i = s1[d, j]
+            sum_sq = s2[d, j]
+            count = c[d, j]
+
+            # Remove current day from L + 1 nearest neighbors
+            if X[t, j] >= 0.001:
+                sum_i -= X[t, j]
+                sum_sq -= X[t, j] ** 2
+                count -= 1
+
+            mean_i = sum_i / L
+            var[t, j] = max(sum_sq - 2 * mean_i * sum_i + count * mean_i ** 2,
+                            0)
 
     return var
@@ -0,0 +1,43 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+
+def process_pool(n_jobs, initializer=None, initargs=()):
+    """
+    Pool of worker processes shared by the models.
+
+    Workers are spawned rather than forked. Forking a process that has
+    already started threads, such as those of dask when reading netCDF files
+    or of Qt in the user interface, can leave the workers waiting forever on
+    locks held by threads that do not exist in the child. Spawned workers
+    start a fresh interpreter, so submitted functions must be defined at
+    module level and their arguments must be picklable.
+
+    Parameters
+    ----------
+    n_jobs : int
+        Number of worker processes.
+    initializer : callable, optional
+        Called with `initargs` in each worker when it starts, e.g. to send
+        data shared by all tasks once per worker instead of once per task.
+    initargs : tuple
+        Arguments of `initializer`.
+
+    Returns
+    -------
+    pool : concurrent.futures.ProcessPoolExecutor
+        The pool, to be used as a context manager.
+    """
+    return ProcessPoolExecutor(max_workers=n_jobs,
+                               mp_context=get_context('spawn'),
+                               initializer=initializer, initargs=initargs)
+
+
+def manager():
+    """
+    Spawned manager process holding objects shared with the workers of a
+    `process_pool`, such as an Event they poll to stop early, which a
+    threading.Event cannot do across processes. Used as a context manager,
+    which must outlive the pool.
+    """
+    return get_context('spawn').Manager()
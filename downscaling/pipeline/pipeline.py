@@ -0,0 +1,400 @@
+"""
+Headless runner chaining the IDW, CFM and KNN models from a declarative
+configuration, so that the models can be run without the user interface,
+e.g. under a batch scheduler with
+
+    python -m downscaling run pipeline.yaml
+
+Stages pass their results on in memory. Each stage is optional and refers
+to the frames of earlier stages by name, or to data files in any format
+supported by `frameio.read_frame`. Relative paths are taken from the folder
+of the configuration file. An example configuration:
+
+    n_jobs: 8
+
+    idw:
+      - varname: pr
+        stations: stations.csv
+        files:
+          his: gcm/pr_day_CanESM2_historical_*.nc
+          fut: gcm/pr_day_CanESM2_rcp45_*.nc
+        extent: [55, 245, 45, 230]
+        chunk_size: 3650
+      - varname: tasmax
+        stations: stations.csv
+        files:
+          his: gcm/tasmax_day_CanESM2_historical_*.nc
+          fut: gcm/tasmax_day_CanESM2_rcp45_*.nc
+
+    cfm:
+      his: his
+      fut: fut
+      observed: observed.csv
+      method: {pr: 1, tasmax: 0}
+      output: scaled.parquet
+
+    knn:
+      input: cfm
+      perturbation: {pr: 2, tasmax: 1}
+      runs: 100
+      seed: 42
+      output: knn.runs
+
+Options of each stage are passed on to the corresponding model, see
+`run_idw`, `run_cfm` and `run_knn`. Results can also be cached on disk, so
+that rerunning a pipeline after changing a later stage does not repeat the
+earlier ones, by adding e.g.
+
+    cache:
+      folder: .cache
+      max_size: 10000000000
+      hash_content: false
+
+with the options of `cache.ResultCache`.
+"""
+import json
+import os
+import sys
+
+import pandas as pd
+import numpy as np
+
+from idw import idw
+from cfm import cfm
+from knncad import knn
+from frameio import frameio
+from cache import cache
+from parallel import parallel
+
+# Options of idw.idw that do not change its result
+IDW_IGNORE = ('weights_dir', 'gather', 'chunk_size')
+
+
+def load_config(path):
+    """
+    Read a pipeline configuration from a YAML (requires PyYAML) or JSON file.
+    The folder of the file is stored under the `root` key for resolving
+    relative paths.
+    """
+    with open(path) as f:
+        if os.path.splitext(path)[1].lower() in ('.yaml', '.yml'):
+            import yaml
+            config = yaml.safe_load(f)
+        else:
+            config = json.load(f)
+
+    config.setdefault('root', os.path.dirname(os.path.abspath(path)))
+
+    return config
+
+
+def run(config, n_jobs=None, chunk_size=None, verbose=True):
+    """
+    Run the stages of a pipeline in order.
+
+    Parameters
+    ----------
+    config : dict
+        Pipeline configuration, see `load_config`.
+    n_jobs : int, optional
+        Number of worker processes of each stage, overriding `n_jobs` in the
+        configuration and in each stage. Defaults to 1.
+    chunk_size : int, optional
+        Number of time steps IDW reads and interpolates at a time, overriding
+        `chunk_size` in the configuration.
+    verbose : bool, default True
+        Print the progress of each stage.
+
+    Returns
+    -------
+    frames : dict
+        Maps the name of each result to its DataFrame. IDW results are named
+        after their `files` keys, the CFM result 'cfm' and the KNN result
+        'knn', unless it was written to a replication store.
+    """
+    root = config.get('root', '.')
+
+    # Stages can set their own number of workers, unless it is given here
+    def stage_jobs(stage):
+        return n_jobs or stage.get('n_jobs', config.get('n_jobs', 1))
+
+    def log(msg):
+        if verbose:
+            print(msg, file=sys.stderr, flush=True)
+
+    frames = {}
+
+    results = None
+    if 'cache' in config:
+        options = dict(config['cache'])
+        folder = resolve_path(options.pop('folder'), root)
+        results = cache.ResultCache(folder, **options)
+
+    if 'idw' in config:
+        stages = config['idw']
+        if isinstance(stages, dict):
+            stages = [stages]
+
+        for stage in stages:
+            if chunk_size:
+                stage = dict(stage, chunk_size=chunk_size)
+            log(f"Interpolating {stage['varname']}...")
+            interpolated = run_idw(stage, root, stage_jobs(stage), results)
+
+            # Variables interpolated for the same files are joined
+            for name, df in interpolated.items():
+                if name in frames:
+                    df = pd.concat([frames[name], df], axis=1)
+                frames[name] = df.sort_index(axis=1)
+
+    if 'cfm' in config:
+        log("Scaling...")
+        frames['cfm'] = run_cfm(config['cfm'], frames, root, results)
+
+    if 'knn' in config:
+        stage = config['knn']
+        log(f"Generating {stage.get('runs', 1)} replications...")
+        result = run_knn(stage, frames, root, stage_jobs(stage), results)
+        if isinstance(result, pd.DataFrame):
+            frames['knn'] = result
+
+    log("Done")
+
+    return frames
+
+
+def run_idw(stage, root='.', n_jobs=1, results=None):
+    """
+    Interpolate one variable of several sets of netCDF files to stations.
+
+    Parameters
+    ----------
+    stage : dict
+        * varname - Name of the variable.
+        * stations - Path to a CSV file of Station, Lat, Lon columns, or a
+          mapping of station names to (lat, lon).
+        * files - Maps the name of each result to a netCDF file, wildcard
+          pattern or list of files.
+        * output - Optional folder to write each result to as
+          `idw_<varname>_<name><fmt>`.
+        * fmt - Extension of the output files, default '.csv'.
+        Other options are passed on to `idw.idw`, e.g. extent, period,
+        alpha, k, metric, weights_dir, gather, chunk_size and dtype.
+    root : str
+        Folder that relative paths are taken from.
+    n_jobs : int
+        Number of files interpolated in parallel.
+    results : cache.ResultCache, optional
+        Cache of results, keyed by the files, see `cache.ResultCache`.
+
+    Returns
+    -------
+    interpolated : dict
+        Maps the name of each set of files to its interpolated DataFrame.
+    """
+    options = dict(stage)
+    varname = options.pop('varname')
+    stations = read_stations(options.pop('stations'), root)
+    files = {name: resolve_path(f, root)
+             for name, f in options.pop('files').items()}
+    output = options.pop('output', None)
+    fmt = options.pop('fmt', '.csv')
+    options.pop('n_jobs', None)
+
+    if 'weights_dir' in options:
+        options['weights_dir'] = resolve_path(options['weights_dir'], root)
+
+    interpolated = {}
+    keys = {}
+
+    # Look up files that have already been interpolated
+    if results is not None:
+        params = {k: v for k, v in options.items() if k not in IDW_IGNORE}
+        for name, f in files.items():
+            keys[name] = results.key(idw.idw, f, varname, stations, **params)
+            df = results.get(keys[name])
+            if df is not None:
+                interpolated[name] = df
+
+    todo = {name: f for name, f in files.items() if name not in interpolated}
+
+    if n_jobs == 1:
+        for name, f in todo.items():
+            interpolated[name] = idw.idw(f, varname, stations, **options)
+    else:
+        with parallel.process_pool(n_jobs) as pool:
+            futures = {name: pool.submit(idw.idw, f, varname, stations,
+                                         **options)
+                       for name, f in todo.items()}
+            for name, f in futures.items():
+                interpolated[name] = f.result()
+
+    if results is not None:
+        for name in todo:
+            results.put(keys[name], interpolated[name])
+
+    if output:
+        output = resolve_path(output, root)
+        os.makedirs(output, exist_ok=True)
+        for name, df in interpolated.items():
+            fpath = os.path.join(output, f"idw_{varname}_{name}{fmt}")
+            frameio.write_frame(df, fpath)
+
+    return {name: interpolated[name] for name in files}
+
+
+def run_cfm(stage, frames, root='.', results=None):
+    """
+    Scale observed data with historical and future GCM data.
+
+    Parameters
+    ----------
+    stage : dict
+        * his, fut - Name of an earlier result or path to a data file.
+        * observed - Name of an earlier result or path to a data file.
+        * method - Scaling method, see `cfm.cfm`.
+        * output - Optional path to write the result to.
+        Other options are passed on to `cfm.cfm`, e.g. bins and dtype.
+    frames : dict
+        Results of earlier stages by name.
+    root : str
+        Folder that relative paths are taken from.
+    results : cache.ResultCache, optional
+        Cache of results, keyed by the content of the data.
+
+    Returns
+    -------
+    result : pandas.DataFrame
+        The scaled observed data.
+    """
+    options = dict(stage)
+    his = resolve_frame(options.pop('his'), frames, root)
+    fut = resolve_frame(options.pop('fut'), frames, root)
+    obs = resolve_frame(options.pop('observed'), frames, root)
+    method = options.pop('method')
+    output = options.pop('output', None)
+
+    # Index level names of GCM data can differ from the observed data
+    his = his.rename_axis(obs.index.names)
+    fut = fut.rename_axis(obs.index.names)
+
+    if results is not None:
+        result = results.call(cfm.cfm, his, fut, obs, method, **options)
+    else:
+        result = cfm.cfm(his, fut, obs, method, **options)
+
+    if output:
+        frameio.write_frame(result, resolve_path(output, root))
+
+    return result
+
+
+def run_knn(stage, frames, root='.', n_jobs=1, results=None):
+    """
+    Generate replications of data with the KNN weather generator.
+
+    Parameters
+    ----------
+    stage : dict
+        * input - Name of an earlier result or path to a data file.
+        * perturbation - Maps each variable to its perturbation type, see
+          `knn.KNN`.
+        * runs - Number of replications, default 1.
+        * seed - Optional seed for reproducible replications.
+        * window, block_size, interp, dtype, distance - Options of
+          `knn.KNN`.
+        * output - Optional path to write the result to. Replications are
+          streamed to a `frameio.ReplicationStore` if it ends with `.runs`.
+    frames : dict
+        Results of earlier stages by name.
+    root : str
+        Folder that relative paths are taken from.
+    n_jobs : int
+        Number of worker processes generating replications.
+    results : cache.ResultCache, optional
+        Cache of results, keyed by the content of the data. Only used when a
+        seed is given and the replications are not written to a store.
+
+    Returns
+    -------
+    result : pandas.DataFrame or frameio.ReplicationStore
+        The replications, or the store they were written to.
+    """
+    X = resolve_frame(stage['input'], frames, root)
+    X = X.rename_axis(['Year', 'Month', 'Day'])
+
+    perturb = stage['perturbation']
+    P = np.array([perturb[v] for v, s in X.columns], np.uint8)
+
+    options = dict(w=stage.get('window', 14),
+                   B=stage.get('block_size', 10),
+                   interp=stage.get('interp', 0.9),
+                   dtype=stage.get('dtype', np.float64),
+                   distance=stage.get('distance', 'euclidean'))
+    runs = stage.get('runs', 1)
+    seed = stage.get('seed')
+
+    output = stage.get('output')
+    if output:
+        output = resolve_path(output, root)
+
+    # Replications are streamed to a replication store
+    if output and os.path.splitext(output)[1] == frameio.STORE:
+        store = frameio.ReplicationStore(output, X.index, X.columns)
+        generator = knn.KNN(X, P, **options)
+        return generator.bootstrap_many(runs, n_jobs=n_jobs, seed=seed,
+                                        store=store)
+
+    # Only reproducible replications can be cached
+    if results is not None and seed is not None:
+        result = results.call(replicate, X, P, runs, seed, n_jobs=n_jobs,
+                              ignore=('n_jobs',), **options)
+    else:
+        result = replicate(X, P, runs, seed, n_jobs=n_jobs, **options)
+
+    if output:
+        frameio.write_frame(result, output)
+
+    return result
+
+
+def replicate(X, P, runs, seed=None, n_jobs=1, **options):
+    """
+    Fit the KNN weather generator to `X` and generate replications, see
+    `knn.KNN` for the options.
+    """
+    generator = knn.KNN(X, P, **options)
+    return generator.bootstrap_many(runs, n_jobs=n_jobs, seed=seed)
+
+
+def read_stations(stations, root='.'):
+    """
+    Get stations as a dict of (lat, lon) by name, from either a mapping or
+    a CSV file with Station, Lat, Lon columns.
+    """
+    if isinstance(stations, dict):
+        return {name: tuple(p) for name, p in stations.items()}
+
+    df = pd.read_csv(resolve_path(stations, root), index_col=0)
+
+    return {name: (lat, lon) for name, lat, lon in df.iloc[:, :2].itertuples()}
+
+
+def resolve_path(path, root='.'):
+    """
+    Join relative paths, or each path of a list, to the root folder.
+    """
+    if isinstance(path, list):
+        return [os.path.join(root, p) for p in path]
+
+    return os.path.join(root, path)
+
+
+def resolve_frame(ref, frames, root='.'):
+    """
+    Get the result of an earlier stage by name, or read a data file.
+    """
+    if ref in frames:
+        return frames[ref]
+
+    return frameio.read_frame(resolve_path(ref, root))
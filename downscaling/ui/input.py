@@ -1,22 +1,77 @@
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtWidgets import QFileDialog
 
+import importlib
 import os
 import sys
+import threading
 import traceback
-from itertools import groupby
 import pandas as pd
 import numpy as np
 
 sys.path.append("..")
 
-from idw import idw
-from cfm import cfm
-from knncad import knn
+# Models are imported when they are first run, see `warm_up_models`
+from frameio import frameio
+
+# File dialog filter for model inputs and outputs
+DATA_FILTER = "Data files (*.csv *.parquet *.feather *.npz)"
+KNN_FILTER = DATA_FILTER + ";;Replication store (*.runs)"
+
+
+def warm_up_models():
+    """
+    Import the models and compile the numba kernels of the KNN weather
+    generator, so that the first run of a model does not wait for them.
+    """
+    importlib.import_module('idw.idw')
+    importlib.import_module('cfm.cfm')
+    knn = importlib.import_module('knncad.knn')
+
+    knn.warm_up()
+
+
+class WorkerSignals(QtCore.QObject):
+    """
+    Signals of a `Worker`, which are delivered on the GUI thread.
+    """
+    progress = QtCore.pyqtSignal(int, str)
+    error = QtCore.pyqtSignal(str)
+    finished = QtCore.pyqtSignal()
+
+
+class Worker(QtCore.QRunnable):
+    def __init__(self, fn, *args, **kwargs):
+        """
+        Runs a job on a thread of a QThreadPool so that the window stays
+        responsive. The job is called as `fn(*args, progress=progress,
+        cancel=cancel, **kwargs)`, where `progress(value, message)` emits the
+        progress signal and `cancel` is a threading.Event set by
+        `Worker.cancel`, which the job and the model loops poll to stop
+        mid-run.
+        """
+        super().__init__()
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.signals = WorkerSignals()
+        self.token = threading.Event()
+
+    def cancel(self):
+        self.token.set()
+
+    def run(self):
+        try:
+            self.fn(*self.args, progress=self.signals.progress.emit,
+                    cancel=self.token, **self.kwargs)
+        except Exception:
+            self.signals.error.emit(traceback.format_exc(5))
+        finally:
+            self.signals.finished.emit()
 
 
 class MainWindow(QtWidgets.QMainWindow):
-    def __init__(self, *args):
+    def __init__(self, *args, warm_up=True):
         super().__init__(*args)
 
         self.ui = Ui_MainWindow()
@@ -33,7 +88,16 @@ class MainWindow(QtWidgets.QMainWindow):
         self.cancelBtn.clicked.connect(self.cancel_pressed)
         self.statusBar().addPermanentWidget(self.cancelBtn)
         self.cancelBtn.hide()
-        self.cancelling = False
+
+        # Model runs are done on a thread pool, one at a time
+        self.pool = QtCore.QThreadPool.globalInstance()
+        self.worker = None
+
+        # Load the models in the background once the window is shown
+        if warm_up:
+            self.warm_up_thread = threading.Thread(target=warm_up_models,
+                                                   daemon=True)
+            QtCore.QTimer.singleShot(0, self.warm_up_thread.start)
 
         # Set up connections for IDW
         self.stations = {}
@@ -41,6 +105,11 @@ class MainWindow(QtWidgets.QMainWindow):
         self.ui.browseBtn.clicked.connect(self.idw_set_input_folder)
         self.ui.outBrowseBtn.clicked.connect(self.idw_set_output_folder)
         self.ui.resetBtn.clicked.connect(self.idw_reset_input)
+
+        # Existing outputs can be brought up to date with new files
+        self.idwIncremental = QtWidgets.QCheckBox("Append new time steps only")
+        index = self.ui.verticalLayout_6.indexOf(self.ui.resetBtn)
+        self.ui.verticalLayout_6.insertWidget(index, self.idwIncremental)
         self.ui.runBtn.clicked.connect(self.idw_run)
 
         # Set up Connections for CFM
@@ -64,9 +133,47 @@ class MainWindow(QtWidgets.QMainWindow):
         tableHHeader.setVisible(True)
 
     def cancel_pressed(self):
-        self.cancelling = True
+        if self.worker:
+            self.worker.cancel()
         self.statusBar().showMessage("Cancelling...")
 
+    def start_worker(self, fn, steps, message, *args):
+        """
+        Run a job in the thread pool, showing its progress out of `steps` in
+        the status bar until it finishes.
+        """
+        if self.worker:
+            QtWidgets.QMessageBox.warning(self, "Busy",
+                                          "Another model is still running.")
+            return
+
+        self.statusBar().showMessage(message)
+        self.progressbar.setRange(0, steps)
+        self.progressbar.setValue(0)
+        self.progressbar.show()
+        self.cancelBtn.show()
+
+        self.worker = Worker(fn, *args)
+        self.worker.signals.progress.connect(self.worker_progress)
+        self.worker.signals.error.connect(self.worker_error)
+        self.worker.signals.finished.connect(self.worker_finished)
+        self.pool.start(self.worker)
+
+    def worker_progress(self, value, message):
+        self.progressbar.setValue(value)
+        if message and not self.worker.token.is_set():
+            self.statusBar().showMessage(message)
+
+    def worker_error(self, msg):
+        QtWidgets.QMessageBox.critical(self, "Error", msg)
+
+    def worker_finished(self):
+        self.worker = None
+        self.statusBar().showMessage("Ready")
+        self.progressbar.reset()
+        self.progressbar.hide()
+        self.cancelBtn.hide()
+
     def idw_set_input_folder(self):
         path = QFileDialog.getExistingDirectory(None, "Select Directory")
         self.ui.pathLineEdit.setText(path)
@@ -92,6 +199,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.ui.westSpin.setValue(0)
         self.ui.timeGroupBox.setChecked(False)
         self.ui.spatialGroupBox.setChecked(False)
+        self.idwIncremental.setChecked(False)
 
         R = self.ui.stationTable.rowCount()
         C = self.ui.stationTable.columnCount()
@@ -171,51 +279,51 @@ class MainWindow(QtWidgets.QMainWindow):
                 extent, period)
 
     def idw_run(self):
-        pars = self.idw_get_input()
-        (path, out, varname, stations, alpha, points, kwargs, files,
-         extent, period) = pars
-
-        def file_splitter(fname):
-            *first, _ = fname.split('_')
-            return first
-
-        self.statusBar().showMessage("Interpolating...")
-        self.progressbar.setRange(0, len(files))
-        self.progressbar.setValue(0)
-        self.progressbar.show()
-        self.cancelBtn.show()
-
+        # Invalid input is reported instead of raising in the slot
         try:
-            for k, group in groupby(files, key=file_splitter):
-                if self.cancelling:
-                    self.cancelling = False
-                    break
-
-                grouped_files = [os.path.join(path, g) for g in group]
-
-                df = idw.idw(grouped_files,
-                             varname,
-                             stations,
-                             extent=extent,
-                             period=period,
-                             alpha=alpha,
-                             k=points,
-                             **kwargs)
-
-                df.to_csv(os.path.join(out, 'idw_' + '_'.join(k)) + '.csv')
-
-                new = self.progressbar.value() + len(grouped_files)
-                self.progressbar.setValue(new)
-
-        except Exception as e:
+            pars = self.idw_get_input()
+        except Exception:
             msg = traceback.format_exc(5)
             QtWidgets.QMessageBox.critical(self, "Error", msg)
+            return
 
-        finally:
-            self.statusBar().showMessage("Ready")
-            self.progressbar.reset()
-            self.progressbar.hide()
-            self.cancelBtn.hide()
+        (path, out, varname, stations, alpha, points, kwargs, files,
+         extent, period) = pars
+
+        self.start_worker(self.idw_job, len(files), "Interpolating...",
+                          path, out, varname, stations, extent, period,
+                          alpha, points, kwargs,
+                          self.idwIncremental.isChecked())
+
+    def idw_job(self, path, out, varname, stations, extent, period, alpha,
+                points, kwargs, incremental, progress, cancel):
+        from idw import idw
+
+        groups = idw.group_files(path, varname)
+        done = []
+
+        def finished(name, n):
+            done.append(n)
+            progress(sum(done), f"Interpolated {name}")
+
+        # Groups on the same grid share interpolation weights, and ten years
+        # are interpolated at a time, writing each block out
+        idw.idw_batch(groups,
+                      out,
+                      varname,
+                      stations,
+                      n_jobs=os.cpu_count(),
+                      progress=finished,
+                      cancel=cancel,
+                      extent=extent,
+                      period=period,
+                      alpha=alpha,
+                      k=points,
+                      weights_dir=os.path.join(out, 'idw_weights'),
+                      gather=True,
+                      chunk_size=3650,
+                      incremental=incremental,
+                      **kwargs)
 
     def cfm_reset_input(self):
         self.ui.cfmVarNameEdit.setText("")
@@ -228,18 +336,18 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def cfm_get_obs_file(self):
         fl, _ = QFileDialog.getOpenFileName(self, "Select Observed File",
-                                            filter="CSV files (*.csv)")
+                                            filter=DATA_FILTER)
         self.ui.observedFileEdit.setText(fl)
 
     def cfm_get_his_file(self):
         fl, _ = QFileDialog.getOpenFileName(self,
                                             "Select Historical GCM File",
-                                            filter="CSV files (*.csv)")
+                                            filter=DATA_FILTER)
         self.ui.historicalFileEdit.setText(fl)
 
     def cfm_get_fut_file(self):
         fl, _ = QFileDialog.getOpenFileName(self, "Select Future GCM File",
-                                            filter="CSV files (*.csv)")
+                                            filter=DATA_FILTER)
         self.ui.futureFileEdit.setText(fl)
 
     def cfm_get_out_path(self):
@@ -247,67 +355,63 @@ class MainWindow(QtWidgets.QMainWindow):
         self.ui.outLineEdit.setText(fl)
 
     def cfm_run(self):
-        self.statusBar().showMessage("Loading Files...")
-        self.progressbar.setRange(0, 4)
-        self.progressbar.show()
-        self.cancelBtn.show()
+        # Several variables can be scaled at once from a comma separated
+        # list, where "name=1" overrides the scaling method of a variable
+        default = self.ui.scalingComboBox.currentIndex()
+        method = {}
 
         try:
-            varname = self.ui.cfmVarNameEdit.text()
-
-            obs_fl = self.ui.observedFileEdit.text()
-            obs = pd.read_csv(obs_fl, index_col=[0, 1, 2], header=[0, 1])
-            obs = obs.sort_index(axis=1)
-            obs = obs.xs(varname, axis=1, level=0, drop_level=False)
-            self.progressbar.setValue(1)
+            for v in self.ui.cfmVarNameEdit.text().split(','):
+                varname, _, m = v.partition('=')
+                method[varname.strip()] = int(m) if m.strip() else default
+        except Exception:
+            msg = traceback.format_exc(5)
+            QtWidgets.QMessageBox.critical(self, "Error", msg)
+            return
 
-            if self.cancelling:
-                self.cancelling = False
-                return
+        obs_fl = self.ui.observedFileEdit.text()
+        his_fl = self.ui.historicalFileEdit.text()
+        fut_fl = self.ui.futureFileEdit.text()
+        bins = self.ui.binsSpinBox.value()
+        out_path = self.ui.outLineEdit.text()
 
-            his_fl = self.ui.historicalFileEdit.text()
-            his = pd.read_csv(his_fl, index_col=[0, 1, 2], header=[0, 1])
-            his = his.sort_index(axis=1)
-            self.progressbar.setValue(2)
+        self.start_worker(self.cfm_job, 4, "Loading Files...", method,
+                          obs_fl, his_fl, fut_fl, bins, out_path)
 
-            if self.cancelling:
-                self.cancelling = False
-                return
+    def cfm_job(self, method, obs_fl, his_fl, fut_fl, bins, out_path,
+                progress, cancel):
+        from cfm import cfm
 
-            fut_fl = self.ui.futureFileEdit.text()
-            fut = pd.read_csv(fut_fl, index_col=[0, 1, 2], header=[0, 1])
-            fut = fut.sort_index(axis=1)
-            self.progressbar.setValue(3)
+        obs = frameio.read_frame(obs_fl)
+        obs = obs[list(method)].sort_index(axis=1)
+        progress(1, "")
 
-            if self.cancelling:
-                self.cancelling = False
-                return
+        if cancel.is_set():
+            return
 
-            method = self.ui.scalingComboBox.currentIndex()
-            bins = self.ui.binsSpinBox.value()
-            out_path = self.ui.outLineEdit.text()
+        his = frameio.read_frame(his_fl)
+        his = his.sort_index(axis=1)
+        progress(2, "")
 
-            fname = os.path.basename(fut_fl)
-            fpath = os.path.join(out_path, f"scaled_{fname}")
+        if cancel.is_set():
+            return
 
-            self.statusBar().showMessage("Scaling...")
+        fut = frameio.read_frame(fut_fl)
+        fut = fut.sort_index(axis=1)
+        progress(3, "Scaling...")
 
-            cfm.cfm(his, fut, obs, method, bins).to_csv(fpath)
+        if cancel.is_set():
+            return
 
-        except Exception as e:
-            msg = traceback.format_exc(5)
-            QtWidgets.QMessageBox.critical(self, "Error", msg)
+        fname = os.path.basename(fut_fl)
+        fpath = os.path.join(out_path, f"scaled_{fname}")
 
-        finally:
-            self.statusBar().showMessage("Ready")
-            self.progressbar.setValue(4)
-            self.progressbar.reset()
-            self.progressbar.hide()
-            self.cancelBtn.hide()
+        frameio.write_frame(cfm.cfm(his, fut, obs, method, bins), fpath)
+        progress(4, "")
 
     def knn_get_input_file(self):
         fl, _ = QFileDialog.getOpenFileName(self, "Select Input File",
-                                            filter="CSV files (*.csv)")
+                                            filter=DATA_FILTER)
         self.ui.knnInputEdit.setText(fl)
 
     def knn_add_file(self):
@@ -333,8 +437,12 @@ class MainWindow(QtWidgets.QMainWindow):
             self.ui.knnTableWidget.removeRow(row.row())
 
     def knn_set_output_folder(self):
-        path, k = QFileDialog.getSaveFileName(None, "Save Output", "", ".csv")
-        self.ui.knnOutputLineEdit.setText(path + k)
+        path, _ = QFileDialog.getSaveFileName(None, "Save Output", "",
+                                              KNN_FILTER)
+        ext = os.path.splitext(path)[1]
+        if path and ext not in frameio.FORMATS and ext != frameio.STORE:
+            path += '.csv'
+        self.ui.knnOutputLineEdit.setText(path)
 
     def knn_reset_input(self):
         self.ui.knnInputEdit.setText("")
@@ -358,62 +466,81 @@ class MainWindow(QtWidgets.QMainWindow):
         B = self.ui.blockSizeSpin.value()
         outpath = self.ui.knnOutputLineEdit.text()
 
-        dfs = []
-        perturb = {}
+        inputs = []
         R = self.ui.knnTableWidget.rowCount()
 
-        self.statusBar().showMessage("Loading Files...")
-        self.progressbar.setRange(0, R + runs)
-        self.progressbar.setValue(0)
-        self.progressbar.show()
-        self.cancelBtn.show()
-
+        # Empty cells have no item and perturbations must be integers
         try:
-
             for i in range(R):
                 v = self.ui.knnTableWidget.item(i, 0).text()
                 f = self.ui.knnTableWidget.item(i, 1).text()
                 p = self.ui.knnTableWidget.item(i, 2).text()
+                inputs.append((v, f, int(p)))
+        except Exception:
+            msg = traceback.format_exc(5)
+            QtWidgets.QMessageBox.critical(self, "Error", msg)
+            return
 
-                perturb[v] = int(p)
-                dfs.append(pd.read_csv(f, index_col=[0, 1, 2], header=[0, 1]))
+        self.start_worker(self.knn_job, R + runs, "Loading Files...", inputs,
+                          w, interp, runs, B, outpath)
 
-                if self.cancelling:
-                    self.cancelling = False
-                    return
+    def knn_job(self, inputs, w, interp, runs, B, outpath, progress,
+                cancel):
+        from knncad import knn
 
-                self.progressbar.setValue(i + 1)
+        dfs = []
+        perturb = {}
+        R = len(inputs)
 
-            df = pd.concat(dfs, axis=1).sort_index(axis=1)
-            P = np.array([perturb[v] for v, s in df.columns], np.uint8)
+        for i, (v, f, p) in enumerate(inputs):
+            perturb[v] = p
+            dfs.append(frameio.read_frame(f))
 
-            generator = knn.KNN(df, P, w=w, B=B, interp=interp)
+            if cancel.is_set():
+                return
 
-            for i, r in enumerate(range(runs)):
-                msg = f"Generating replication {i + 1} of {runs}"
-                self.statusBar().showMessage(msg)
+            progress(i + 1, "")
 
-                if self.cancelling:
-                    self.cancelling = False
-                    return
+        df = pd.concat(dfs, axis=1).sort_index(axis=1)
+        P = np.array([perturb[v] for v, s in df.columns], np.uint8)
 
-                result = generator.bootstrap(i)
-                if i == 0:
-                    result.to_csv(outpath)
-                else:
-                    result.to_csv(outpath, mode='a')
+        progress(R, "Fitting...")
+        generator = knn.KNN(df, P, w=w, B=B, interp=interp)
 
-                self.progressbar.setValue(R + i)
+        if cancel.is_set():
+            return
 
-        except Exception as e:
-            msg = traceback.format_exc(5)
-            QtWidgets.QMessageBox.critical(self, "Error", msg)
+        def finished(r):
+            msg = f"Generated replication {r + 1} of {runs}"
+            progress(R + r + 1, msg)
 
-        finally:
-            self.statusBar().showMessage("Ready")
-            self.progressbar.reset()
-            self.progressbar.hide()
-            self.cancelBtn.hide()
+        # Replications are streamed to a replication store
+        if os.path.splitext(outpath)[1] == frameio.STORE:
+            store = frameio.ReplicationStore(outpath, df.index, df.columns)
+            generator.bootstrap_many(runs, store=store, progress=finished,
+                                     cancel=cancel)
+            return
+
+        # Replications are appended to CSV files as they are generated
+        stream = frameio.frame_format(outpath) == '.csv'
+        results = []
+
+        for i in range(runs):
+            if cancel.is_set():
+                return
+
+            result = generator.bootstrap(i)
+            if not stream:
+                results.append(result)
+            elif i == 0:
+                result.to_csv(outpath)
+            else:
+                result.to_csv(outpath, mode='a')
+
+            finished(i)
+
+        if results:
+            frameio.write_frame(pd.concat(results), outpath)
 
 
 class PastableTableWidget(QtWidgets.QTableWidget):